@@ -0,0 +1,136 @@
+# Copyright 2024 The Chain-of-Table authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+# Compares the select_column table formatter with the previous
+# DataFrame + NoIndent + MyEncoder implementation on wide tables.
+#
+#   python -m benchmarks.select_column_prompt --num_rows 20 --repeat 20
+
+
+import json
+import random
+import re
+import timeit
+from _ctypes import PyObj_FromPtr
+
+import fire
+import pandas as pd
+
+from utils.helper import table2column_priority_json
+
+
+def table2df(table_text, num_rows=100):
+    header, rows = table_text[0], table_text[1:]
+    rows = rows[:num_rows]
+    df = pd.DataFrame(data=rows, columns=header)
+    return df
+
+
+class NoIndent(object):
+    """Value wrapper."""
+
+    def __init__(self, value):
+        self.value = value
+
+
+class MyEncoder(json.JSONEncoder):
+    FORMAT_SPEC = "@@{}@@"
+    regex = re.compile(FORMAT_SPEC.format(r"(\d+)"))
+
+    def __init__(self, **kwargs):
+        # Save copy of any keyword argument values needed for use here.
+        self.__sort_keys = kwargs.get("sort_keys", None)
+        super(MyEncoder, self).__init__(**kwargs)
+
+    def default(self, obj):
+        return (
+            self.FORMAT_SPEC.format(id(obj))
+            if isinstance(obj, NoIndent)
+            else super(MyEncoder, self).default(obj)
+        )
+
+    def encode(self, obj):
+        format_spec = self.FORMAT_SPEC  # Local var to expedite access.
+        json_repr = super(MyEncoder, self).encode(obj)  # Default JSON.
+
+        # Replace any marked-up object ids in the JSON repr with the
+        # value returned from the json.dumps() of the corresponding
+        # wrapped Python object.
+        for match in self.regex.finditer(json_repr):
+            # see https://stackoverflow.com/a/15012814/355230
+            id = int(match.group(1))
+            no_indent = PyObj_FromPtr(id)
+            json_obj_repr = json.dumps(no_indent.value, sort_keys=self.__sort_keys)
+
+            # Replace the matched id string with json formatted representation
+            # of the corresponding Python object.
+            json_repr = json_repr.replace(
+                '"{}"'.format(format_spec.format(id)), json_obj_repr
+            )
+
+        return json_repr
+
+
+def legacy_table2column_priority_json(table_text, num_rows=100, caption=None):
+    df = table2df(table_text, num_rows=num_rows)
+    list_table = [list(df.columns)] + df.values.tolist()
+    list_table = [
+        [list_table[i][j] for i in range(len(list_table))]
+        for j in range(len(list_table[0]))
+    ]
+    dic = {}
+    if caption is not None:
+        dic["table_caption"] = caption
+    dic["columns"] = NoIndent(list(df.columns))
+    dic["table_column_priority"] = [NoIndent(i) for i in list_table]
+    return json.dumps(dic, cls=MyEncoder, ensure_ascii=False, sort_keys=False, indent=2)
+
+
+def make_table(num_columns, num_rows, seed=0):
+    rng = random.Random(seed)
+    words = ["league", "fa cup", "olímpic", "2008", "32,092", "w 27–21", "t5", ""]
+    header = [f"column {j}" for j in range(num_columns)]
+    rows = [
+        [rng.choice(words) + str(rng.randint(0, 99)) for _ in range(num_columns)]
+        for _ in range(num_rows)
+    ]
+    return [header] + rows
+
+
+def main(num_rows: int = 20, repeat: int = 20, widths=(10, 50, 200, 800)):
+    print(f"{'columns':>8} {'legacy (ms)':>12} {'new (ms)':>10} {'speedup':>8}")
+    for num_columns in widths:
+        table_text = make_table(num_columns, num_rows)
+        caption = "wide table"
+        assert legacy_table2column_priority_json(
+            table_text, caption=caption
+        ) == table2column_priority_json(table_text, caption=caption)
+
+        legacy = timeit.timeit(
+            lambda: legacy_table2column_priority_json(table_text, caption=caption),
+            number=repeat,
+        )
+        new = timeit.timeit(
+            lambda: table2column_priority_json(table_text, caption=caption),
+            number=repeat,
+        )
+        print(
+            f"{num_columns:>8} {legacy / repeat * 1000:>12.2f} "
+            f"{new / repeat * 1000:>10.2f} {legacy / new:>7.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -0,0 +1,82 @@
+# Copyright 2024 The Chain-of-Table authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+# Compares the table backends of group_column and sort_column on long
+# tables. "cold" runs get a fresh table, so they include building the column
+# profile and loading the table in the backend; "warm" runs reuse a table, as
+# the steps and samples sharing a table do.
+#
+#   python -m benchmarks.table_backend --num_groups 100 --repeat 5
+
+
+import random
+import time
+
+import fire
+
+from operations.group_by import _group_column
+from operations.sort_by import _sort_column
+from utils.table import Table
+
+
+def make_table(num_rows, num_groups, seed=0):
+    rng = random.Random(seed)
+    header = ["country", "points", "athlete"]
+    rows = [
+        [
+            f"country {rng.randrange(num_groups)}",
+            f"{rng.randint(0, 10**6):,}" if rng.random() > 0.05 else "n/a",
+            f"athlete {i}",
+        ]
+        for i in range(num_rows)
+    ]
+    return [header] + rows
+
+
+def run(table, backend):
+    group_info = _group_column(table, 0, backend)
+    sort_result = _sort_column(table, 1, "large to small", "Numerical", backend)
+    return group_info, sort_result
+
+
+def main(
+    num_groups: int = 100,
+    repeat: int = 5,
+    lengths=(100, 1000, 10000, 50000),
+    backends=("python", "sqlite", "numpy"),
+):
+    print(f"{'rows':>8} {'backend':>8} {'cold (ms)':>10} {'warm (ms)':>10}")
+    for num_rows in lengths:
+        table_text = make_table(num_rows, num_groups)
+        expected = run(Table.from_table_text(table_text), "python")
+        for backend in backends:
+            table = Table.from_table_text(table_text)
+            assert run(table, backend) == expected
+
+            start = time.perf_counter()
+            for _ in range(repeat):
+                run(Table.from_table_text(table_text), backend)
+            cold = (time.perf_counter() - start) / repeat
+            start = time.perf_counter()
+            for _ in range(repeat):
+                run(table, backend)
+            warm = (time.perf_counter() - start) / repeat
+            print(
+                f"{num_rows:>8} {backend:>8} {cold * 1000:>10.2f} {warm * 1000:>10.2f}"
+            )
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
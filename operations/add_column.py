@@ -16,7 +16,15 @@
 import re
 import copy
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from utils.helper import table2string
+from utils.table import Table
+from utils.profile import column_profile
+from utils.pattern_induction import (
+    induce_extraction_program,
+    apply_extraction_program,
+    parse_source_column,
+)
 
 
 add_column_demo = """To tell the statement is true or false, we can first use f_add_column() to add more columns to the table.
@@ -115,18 +123,65 @@ def add_column_build_prompt(table_text, statement, table_caption=None, num_rows=
     return prompt
 
 
+def get_add_column_rejection(
+    add_column, add_column_contents, table_text, partial=False
+):
+    # The reason why a new column is not added to the table, or None. With
+    # `partial`, `add_column_contents` only has the values of the first rows
+    # (i.e. the proposal of the LLM), and only the rules that can already be
+    # decided on them are applied.
+    headers = table_text.header
+    num_rows = len(add_column_contents) if partial else table_text.num_rows
+
+    header2contents = {}
+    for i, header in enumerate(headers):
+        header2contents[header] = column_profile(table_text, i)["values"][:num_rows]
+
+    if add_column.startswith("number of"):
+        return "remove number of"
+
+    if not partial and len(set(add_column_contents)) == 1:
+        return "all same"
+
+    for x in add_column_contents:
+        if x.strip() == "":
+            return "empty cell"
+
+    if add_column in headers:
+        return "same column header"
+
+    if not partial:
+        for header in header2contents:
+            if add_column_contents == header2contents[header]:
+                return "different header, same content"
+
+    for header, contents in header2contents.items():
+        if all(add_column_contents[i] in contents[i] for i in range(len(contents))):
+            return None
+    return "not substring of a column"
+
+
 def add_column_func(
-    sample, table_info, llm, llm_options=None, debug=False, skip_op=[], strategy="top"
+    sample,
+    table_info,
+    llm,
+    llm_options=None,
+    debug=False,
+    skip_op=[],
+    strategy="top",
+    batch_size=10,
+    n_threads=8,
+    induce_pattern=True,
 ):
     operation = {
         "operation_name": "add_column",
         "parameter_and_conf": [],
     }
-    failure_sample_copy = copy.deepcopy(sample)
-    failure_sample_copy["chain"].append(operation)
+    failure_sample_copy = copy.copy(sample)
+    failure_sample_copy["chain"] = sample["chain"] + [operation]
 
     # table_info = get_table_info(sample, skip_op=skip_op)
-    table_text = table_info["table_text"]
+    table_text = Table.from_table_text(table_info["table_text"])
 
     table_caption = sample["table_caption"]
     cleaned_statement = sample["cleaned_statement"]
@@ -176,8 +231,14 @@ def add_column_func(
 
     add_column, first_3_values, llm_response = eval(selected_add_column_key)
 
-    existing_columns = table_text[0]
-    if add_column in existing_columns:
+    # reject the column before extracting the values of the other rows if
+    # add_column_act is bound to skip it
+    rejection = get_add_column_rejection(
+        add_column, first_3_values, table_text, partial=True
+    )
+    if rejection is not None:
+        if debug:
+            print("Rejected new column: ", rejection)
         return failure_sample_copy
 
     add_column_contents = [] + first_3_values
@@ -206,7 +267,8 @@ def add_column_func(
 
     headers = table_text[0]
     rows = table_text[1:]
-    for i in range(3, len(rows)):
+
+    def _extract_row(i):
         partial_table_text = [headers] + rows[i : i + 1]
         cur_prompt = (
             new_prompt
@@ -229,8 +291,89 @@ def add_column_func(
         contents = cur_response
         if "|" in contents:
             contents = contents.split("|")[0].strip()
+        return contents
+
+    def _extract_batch(row_ids):
+        # ask for the values of several rows in one request, in the same
+        # "v1 | v2 | v3" format as the first three values; rows whose value
+        # cannot be aligned are returned as None
+        partial_table_text = [headers] + [rows[i] for i in row_ids]
+        cur_prompt = (
+            new_prompt
+            + "\n\n"
+            + _sample_to_simple_prompt_header(
+                partial_table_text, num_rows=len(row_ids)
+            )
+            + explanaiton_beginning
+        )
+        cur_response = llm.generate(
+            cur_prompt,
+            options=llm.get_model_options(
+                per_example_max_decode_steps=max(150, 20 * len(row_ids)),
+                per_example_top_p=1.0,
+            ),
+        ).strip()
+        if debug:
+            print(cur_prompt)
+            print(cur_response)
+            print("---")
+            print()
 
-        add_column_contents.append(contents)
+        lines = cur_response.split("\n")
+        values = [v.strip() for v in lines[0].split("|")]
+        if len(values) != len(row_ids):
+            return [None] * len(row_ids)
+        return [v if v else None for v in values]
+
+    def _extract_following_contents():
+        following_contents = [None] * (len(rows) - 3)
+
+        # most columns are a plain extraction from the column named in the
+        # explanation, so try to learn it from the first three values and
+        # apply it locally
+        source_column = parse_source_column(explanaiton_beginning)
+        if induce_pattern and source_column is not None and len(rows) > 3:
+            program = induce_extraction_program(
+                headers, rows[:3], first_3_values, source_column=source_column
+            )
+            if debug:
+                print("Extraction program: ", program)
+            if program is not None:
+                for i in range(3, len(rows)):
+                    following_contents[i - 3] = apply_extraction_program(
+                        program, rows[i]
+                    )
+
+        if batch_size > 1:
+            batch_rows = [
+                i for i in range(3, len(rows)) if following_contents[i - 3] is None
+            ]
+            for start in range(0, len(batch_rows), batch_size):
+                row_ids = batch_rows[start : start + batch_size]
+                for i, contents in zip(row_ids, _extract_batch(row_ids)):
+                    following_contents[i - 3] = contents
+
+        # rows left (all of them without pattern induction and batching) fall
+        # back to one request per row
+        fallback_rows = [
+            i for i in range(3, len(rows)) if following_contents[i - 3] is None
+        ]
+        if fallback_rows:
+            with ThreadPoolExecutor(max_workers=n_threads) as executor:
+                for i, contents in zip(
+                    fallback_rows, executor.map(_extract_row, fallback_rows)
+                ):
+                    following_contents[i - 3] = contents
+        return following_contents
+
+    # statements on the same table often ask for the same column, so the
+    # extraction is shared through the table memo
+    following_contents = table_text.memoize(
+        ("add_column", add_column, tuple(first_3_values), batch_size, induce_pattern),
+        _extract_following_contents,
+    )
+
+    add_column_contents += following_contents
 
     if debug:
         print("New col contents: ", add_column_contents)
@@ -244,17 +387,17 @@ def add_column_func(
         "parameter_and_conf": add_column_info,
     }
 
-    sample_copy = copy.deepcopy(sample)
-    sample_copy["chain"].append(operation)
+    sample_copy = copy.copy(sample)
+    sample_copy["chain"] = sample["chain"] + [operation]
 
     return sample_copy
 
 
 def add_column_act(table_info, operation, skip_op=[], debug=False):
-    table_info = copy.deepcopy(table_info)
+    table_info = copy.copy(table_info)
 
-    failure_table_info = copy.deepcopy(table_info)
-    failure_table_info["act_chain"].append("skip f_add_column()")
+    failure_table_info = copy.copy(table_info)
+    failure_table_info["act_chain"] = table_info["act_chain"] + ["skip f_add_column()"]
     if "add_column" in skip_op:
         return failure_table_info
     if len(operation["parameter_and_conf"]) == 0:
@@ -263,76 +406,22 @@ def add_column_act(table_info, operation, skip_op=[], debug=False):
     add_column_key, _ = operation["parameter_and_conf"][0]
     add_column, add_column_contents = eval(add_column_key)
 
-    table_text = table_info["table_text"]
-    headers = table_text[0]
-    rows = table_text[1:]
+    table_text = Table.from_table_text(table_info["table_text"])
 
-    header2contents = {}
-    for i, header in enumerate(headers):
-        header2contents[header] = []
-        for row in rows:
-            header2contents[header].append(row[i])
-
-    if add_column.startswith("number of"):
-        # remove 'number of'
-        if debug:
-            print("remove number of")
-        return failure_table_info
-
-    if len(set(add_column_contents)) == 1:
-        # all same
+    rejection = get_add_column_rejection(add_column, add_column_contents, table_text)
+    if rejection is not None:
         if debug:
-            print("all same")
-        return failure_table_info
-
-    for x in add_column_contents:
-        if x.strip() == "":
-            # empty cell
-            if debug:
-                print("empty cell")
-            return failure_table_info
-
-    if add_column in headers:
-        # same column header
-        if debug:
-            print("same column header")
-        return failure_table_info
-
-    for header in header2contents:
-        if add_column_contents == header2contents[header]:
-            # different header, same content
-            if debug:
-                print("different header, same content")
-            return failure_table_info
-
-    exist_flag = False
-
-    for header, contents in header2contents.items():
-        current_column_exist_flag = True
-
-        for i in range(len(contents)):
-            if add_column_contents[i] not in contents[i]:
-                current_column_exist_flag = False
-                break
-
-        if current_column_exist_flag:
-            exist_flag = True
-            break
-    if not exist_flag:
-        if debug:
-            print(add_column, add_column_contents)
-            print("not substring of a column")
+            if rejection == "not substring of a column":
+                print(add_column, add_column_contents)
+            print(rejection)
         return failure_table_info
 
     if debug:
         print("default")
-    new_headers = headers + [add_column]
-    new_rows = []
-    for i, row in enumerate(rows):
-        row.append(add_column_contents[i])
-        new_rows.append(row)
+    new_table_text = table_text.add_column(
+        add_column, add_column_contents[: table_text.num_rows]
+    )
 
-    new_table_text = [new_headers] + new_rows
     table_info["table_text"] = new_table_text
-    table_info["act_chain"].append(f"f_add_column({add_column})")
+    table_info["act_chain"] = table_info["act_chain"] + [f"f_add_column({add_column})"]
     return table_info
@@ -16,6 +16,7 @@
 import copy
 import numpy as np
 from utils.helper import table2string
+from utils.token_budget import fit_table
 
 
 general_demo = """/*
@@ -73,39 +74,45 @@ def simple_query(sample, table_info, llm, debug=False, use_demo=False, llm_optio
     caption = sample["table_caption"]
     statement = sample["statement"]
 
-    prompt = ""
-    prompt += "Here are the statement about the table and the task is to tell whether the statement is True or False.\n"
-    prompt += "If the statement is true, answer YES, and otherwise answer NO.\n"
-
-    if use_demo:
-        prompt += "\n"
-        prompt += general_demo + "\n\n"
+    def _build_prompt(table_text, row_ids):
+        prompt = ""
         prompt += "Here are the statement about the table and the task is to tell whether the statement is True or False.\n"
         prompt += "If the statement is true, answer YES, and otherwise answer NO.\n"
-        prompt += "\n"
 
-    prompt += "/*\n"
-    prompt += table2string(table_text, caption=caption) + "\n"
-    prompt += "*/\n"
+        if use_demo:
+            prompt += "\n"
+            prompt += general_demo + "\n\n"
+            prompt += "Here are the statement about the table and the task is to tell whether the statement is True or False.\n"
+            prompt += "If the statement is true, answer YES, and otherwise answer NO.\n"
+            prompt += "\n"
 
-    if "group_sub_table" in table_info:
-        group_column, group_info = table_info["group_sub_table"]
         prompt += "/*\n"
-        prompt += "Group the rows according to column: {}.\n".format(group_column)
-        group_headers = ["Group ID", group_column, "Count"]
-        group_rows = []
-        for i, (v, count) in enumerate(group_info):
-            if v.strip() == "":
-                v = "[Empty Cell]"
-            group_rows.append([f"Group {i+1}", v, str(count)])
-        prompt += " | ".join(group_headers) + "\n"
-        for row in group_rows:
-            prompt += " | ".join(row) + "\n"
+        prompt += table2string(table_text, caption=caption, row_ids=row_ids) + "\n"
         prompt += "*/\n"
 
-    prompt += "Statement: " + statement + "\n"
-
-    prompt += "The answer is:"
+        if "group_sub_table" in table_info:
+            group_column, group_info = table_info["group_sub_table"]
+            prompt += "/*\n"
+            prompt += "Group the rows according to column: {}.\n".format(group_column)
+            group_headers = ["Group ID", group_column, "Count"]
+            group_rows = []
+            for i, (v, count) in enumerate(group_info):
+                if v.strip() == "":
+                    v = "[Empty Cell]"
+                group_rows.append([f"Group {i+1}", v, str(count)])
+            prompt += " | ".join(group_headers) + "\n"
+            for row in group_rows:
+                prompt += " | ".join(row) + "\n"
+            prompt += "*/\n"
+
+        prompt += "Statement: " + statement + "\n"
+
+        prompt += "The answer is:"
+        return prompt
+
+    prompt = _build_prompt(
+        *fit_table(llm, llm_options, table_text, statement, _build_prompt)
+    )
     responses = llm.generate_plus_with_score(prompt, options=llm_options)
     responses = [(res.strip(), np.exp(score)) for res, score in responses]
 
@@ -117,8 +124,8 @@ def simple_query(sample, table_info, llm, debug=False, use_demo=False, llm_optio
         "operation_name": "simple_query",
         "parameter_and_conf": responses,
     }
-    sample_copy = copy.deepcopy(sample)
-    sample_copy["chain"].append(operation)
+    sample_copy = copy.copy(sample)
+    sample_copy["chain"] = sample["chain"] + [operation]
 
     return sample_copy
 
@@ -17,6 +17,9 @@ import re
 import numpy as np
 import copy
 from utils.helper import table2string
+from utils.table import Table
+from utils.table_backend import get_table_backend
+from utils.profile import column_profile, check_if_group, get_infeasible_operations
 
 
 group_column_demo = """To tell the statement is true or false, we can first use f_group() to group the values in a column.
@@ -60,10 +63,36 @@ def group_column_build_prompt(table_text, statement, table_caption=None, num_row
     return prompt
 
 
+def _group_column(table_text, index, backend="python"):
+    # [(value, count)] by decreasing count, then by value
+    table_backend = get_table_backend(table_text, backend)
+    if table_backend is not None:
+        return table_backend.group_counts(index)
+    value_counts = column_profile(table_text, index)["value_counts"]
+    return sorted(value_counts.items(), key=lambda x: (-x[1], x[0]))
+
+
 def group_column_func(
-    sample, table_info, llm, llm_options=None, debug=False, skip_op=[]
+    sample,
+    table_info,
+    llm,
+    llm_options=None,
+    debug=False,
+    skip_op=[],
+    backend="python",
 ):
-    table_text = table_info["table_text"]
+    table_text = Table.from_table_text(table_info["table_text"])
+
+    if "group_column" in get_infeasible_operations(table_text):
+        # no column can be grouped, do not ask the LLM
+        operation = {
+            "operation_name": "group_column",
+            "parameter_and_conf": [],
+            "infeasible": True,
+        }
+        sample_copy = copy.copy(sample)
+        sample_copy["chain"] = sample["chain"] + [operation]
+        return sample_copy
 
     table_caption = sample["table_caption"]
     statement = sample["statement"]
@@ -84,7 +113,6 @@ def group_column_func(
     group_column_and_conf = {}
 
     headers = table_text[0]
-    rows = table_text[1:]
     for res, score in responses:
         re_result = re.findall(r"f_group\(([^\)]*)\)", res, re.S)
 
@@ -102,26 +130,11 @@ def group_column_func(
         group_column_and_conf[group_column] += np.exp(score)
 
     for group_column, conf in group_column_and_conf.items():
-        group_column_contents = []
         index = headers.index(group_column)
-        for row in rows:
-            group_column_contents.append(row[index])
-
-        def check_if_group(vs):
-            vs_without_empty = [v for v in vs if v.strip()]
-            return len(set(vs_without_empty)) / len(vs_without_empty) <= 0.8
-
-        if not check_if_group(group_column_contents):
+        if not check_if_group(column_profile(table_text, index)):
             continue
 
-        vs_to_group = []
-        for i in range(len(group_column_contents)):
-            vs_to_group.append((group_column_contents[i], i))
-
-        group_info = []
-        for v in sorted(set(group_column_contents)):
-            group_info.append((v, group_column_contents.count(v)))
-        group_info = sorted(group_info, key=lambda x: x[1], reverse=True)
+        group_info = _group_column(table_text, index, backend)
 
         group_key = str((group_column, group_info))
         group_param_and_conf[group_key] = conf
@@ -135,17 +148,17 @@ def group_column_func(
         "parameter_and_conf": group_param_and_conf_list,
     }
 
-    sample_copy = copy.deepcopy(sample)
-    sample_copy["chain"].append(operation)
+    sample_copy = copy.copy(sample)
+    sample_copy["chain"] = sample["chain"] + [operation]
 
     return sample_copy
 
 
 def group_column_act(table_info, operation, strategy="top", skip_op=[]):
-    table_info = copy.deepcopy(table_info)
+    table_info = copy.copy(table_info)
 
-    failure_table_info = copy.deepcopy(table_info)
-    failure_table_info["act_chain"].append("skip f_group_column()")
+    failure_table_info = copy.copy(table_info)
+    failure_table_info["act_chain"] = table_info["act_chain"] + ["skip f_group_column()"]
 
     if "group_column" in skip_op:
         return failure_table_info
@@ -157,6 +170,6 @@ def group_column_act(table_info, operation, strategy="top", skip_op=[]):
         raise NotImplementedError()
 
     table_info["group_sub_table"] = (group_column, group_info)
-    table_info["act_chain"].append(f"f_group_column({group_column})")
+    table_info["act_chain"] = table_info["act_chain"] + [f"f_group_column({group_column})"]
 
     return table_info
@@ -13,38 +13,21 @@
 # limitations under the License.
 
 
-import json
 import copy
 import re
 import numpy as np
-from utils.helper import table2df, NoIndent, MyEncoder
+from utils.llm import generate_until_consensus
+from utils.helper import table2column_priority_json
+from utils.column_linker import link_columns
+from utils.table import Table
+from utils.token_budget import fit_table
 
 from third_party.select_column_row_prompts.select_column_row_prompts import select_column_demo
 
 
-def twoD_list_transpose(arr, keep_num_rows=3):
-    arr = arr[: keep_num_rows + 1] if keep_num_rows + 1 <= len(arr) else arr
-    return [[arr[i][j] for i in range(len(arr))] for j in range(len(arr[0]))]
-
-
 def select_column_build_prompt(table_text, statement, table_caption=None, num_rows=100):
-    df = table2df(table_text, num_rows=num_rows)
-    tmp = df.values.tolist()
-    list_table = [list(df.columns)] + tmp
-    list_table = twoD_list_transpose(list_table, len(list_table))
-    if table_caption is not None:
-        dic = {
-            "table_caption": table_caption,
-            "columns": NoIndent(list(df.columns)),
-            "table_column_priority": [NoIndent(i) for i in list_table],
-        }
-    else:
-        dic = {
-            "columns": NoIndent(list(df.columns)),
-            "table_column_priority": [NoIndent(i) for i in list_table],
-        }
-    linear_dic = json.dumps(
-        dic, cls=MyEncoder, ensure_ascii=False, sort_keys=False, indent=2
+    linear_dic = table2column_priority_json(
+        table_text, num_rows=num_rows, caption=table_caption
     )
     prompt = "/*\ntable = " + linear_dic + "\n*/\n"
     prompt += "statement : " + statement + ".\n"
@@ -52,36 +35,94 @@ def select_column_build_prompt(table_text, statement, table_caption=None, num_ro
     return prompt
 
 
-def select_column_func(sample, table_info, llm, llm_options, debug=False, num_rows=100):
+def _parse_select_column_response(res):
+    try:
+        pred = re.findall(r"f_col\(\[(.*?)\]\)", res, re.S)[0].strip()
+    except Exception:
+        return None
+    pred = pred.split(", ")
+    pred = [i.strip() for i in pred]
+    pred = sorted(pred)
+    return str(pred)
+
+
+def select_column_func(
+    sample,
+    table_info,
+    llm,
+    llm_options,
+    debug=False,
+    num_rows=100,
+    early_consensus=False,
+    union_num=2,
+    link_threshold=None,
+    validate_link=False,
+):
     # table_info = get_table_info(sample)
     table_text = table_info["table_text"]
 
     table_caption = sample["table_caption"]
     statement = sample["statement"]
 
-    prompt = "" + select_column_demo.rstrip() + "\n\n"
-    prompt += select_column_build_prompt(
-        table_text, statement, table_caption, num_rows=num_rows
+    column_link = None
+    if link_threshold is not None:
+        columns, confidence = link_columns(table_text, statement)
+        column_link = {
+            "columns": columns,
+            "confidence": confidence,
+            "confident": confidence >= link_threshold,
+            "used": False,
+        }
+        # with `validate_link`, the LLM is asked anyway to measure the agreement
+        if column_link["confident"] and not validate_link:
+            column_link["used"] = True
+            pred = str(sorted(column.lower() for column in columns))
+            operation = {
+                "operation_name": "select_column",
+                "parameter_and_conf": [(pred, 1.0)],
+                "column_link": column_link,
+            }
+            sample_copy = copy.copy(sample)
+            sample_copy["chain"] = sample["chain"] + [operation]
+            return sample_copy
+
+    def _build_prompt(table_text, row_ids):
+        prompt = "" + select_column_demo.rstrip() + "\n\n"
+        prompt += select_column_build_prompt(
+            table_text, statement, table_caption, num_rows=num_rows
+        )
+        return prompt
+
+    # all the columns stay in the prompt, so that any of them can be selected
+    prompt = _build_prompt(
+        *fit_table(
+            llm,
+            llm_options,
+            table_text,
+            statement,
+            _build_prompt,
+            num_rows=num_rows,
+            drop_columns=False,
+        )
     )
 
-    responses = llm.generate_plus_with_score(prompt, options=llm_options)
+    if early_consensus:
+        # stop sampling once the top `union_num` answers of the act are known
+        responses = generate_until_consensus(
+            llm, prompt, llm_options, _parse_select_column_response, top_k=union_num
+        )
+    else:
+        responses = llm.generate_plus_with_score(prompt, options=llm_options)
 
     if debug:
         print(prompt)
         print(responses)
 
-    pattern_col = r"f_col\(\[(.*?)\]\)"
-
     pred_conf_dict = {}
     for res, score in responses:
-        try:
-            pred = re.findall(pattern_col, res, re.S)[0].strip()
-        except Exception:
+        pred = _parse_select_column_response(res)
+        if pred is None:
             continue
-        pred = pred.split(", ")
-        pred = [i.strip() for i in pred]
-        pred = sorted(pred)
-        pred = str(pred)
         if pred not in pred_conf_dict:
             pred_conf_dict[pred] = 0
         pred_conf_dict[pred] += np.exp(score)
@@ -92,18 +133,20 @@ def select_column_func(sample, table_info, llm, llm_options, debug=False, num_ro
         "operation_name": "select_column",
         "parameter_and_conf": select_col_rank,
     }
+    if column_link is not None:
+        operation["column_link"] = column_link
 
-    sample_copy = copy.deepcopy(sample)
-    sample_copy["chain"].append(operation)
+    sample_copy = copy.copy(sample)
+    sample_copy["chain"] = sample["chain"] + [operation]
 
     return sample_copy
 
 
 def select_column_act(table_info, operation, union_num=2, skip_op=[]):
-    table_info = copy.deepcopy(table_info)
+    table_info = copy.copy(table_info)
 
-    failure_table_info = copy.deepcopy(table_info)
-    failure_table_info["act_chain"].append("skip f_select_column()")
+    failure_table_info = copy.copy(table_info)
+    failure_table_info["act_chain"] = table_info["act_chain"] + ["skip f_select_column()"]
 
     if "select_column" in skip_op:
         return failure_table_info
@@ -111,9 +154,6 @@ def select_column_act(table_info, operation, union_num=2, skip_op=[]):
     def union_lists(to_union):
         return list(set().union(*to_union))
 
-    def twoD_list_transpose(arr):
-        return [[arr[i][j] for i in range(len(arr))] for j in range(len(arr[0]))]
-
     selected_columns_info = operation["parameter_and_conf"]
     selected_columns_info = sorted(
         selected_columns_info, key=lambda x: x[1], reverse=True
@@ -125,21 +165,21 @@ def select_column_act(table_info, operation, union_num=2, skip_op=[]):
 
     real_selected_columns = []
 
-    table_text = table_info["table_text"]
-    table = twoD_list_transpose(table_text)
-    new_table = []
-    for cols in table:
-        if cols[0].lower() in selected_columns:
-            real_selected_columns.append(cols[0])
-            new_table.append(copy.deepcopy(cols))
-    if len(new_table) == 0:
-        new_table = table
+    table_text = Table.from_table_text(table_info["table_text"])
+    column_indices = []
+    for i, header in enumerate(table_text.header):
+        if header.lower() in selected_columns:
+            real_selected_columns.append(header)
+            column_indices.append(i)
+    if len(column_indices) == 0:
+        new_table = table_text
         real_selected_columns = ["*"]
-    new_table = twoD_list_transpose(new_table)
+    else:
+        new_table = table_text.select_columns(column_indices)
 
     table_info["table_text"] = new_table
-    table_info["act_chain"].append(
+    table_info["act_chain"] = table_info["act_chain"] + [
         f"f_select_column({', '.join(real_selected_columns)})"
-    )
+    ]
 
     return table_info
@@ -16,13 +16,21 @@
 import copy
 import re
 import numpy as np
+from utils.llm import generate_until_consensus
 from utils.helper import table2string
+from utils.row_index import get_row_index
+from utils.table import Table
+from utils.token_budget import fit_table
 
 from third_party.select_column_row_prompts.select_column_row_prompts import select_row_demo
 
 
-def select_row_build_prompt(table_text, statement, table_caption=None, num_rows=100):
-    table_str = table2string(table_text, caption=table_caption).strip()
+def select_row_build_prompt(
+    table_text, statement, table_caption=None, num_rows=100, row_ids=None
+):
+    table_str = table2string(
+        table_text, caption=table_caption, num_rows=num_rows, row_ids=row_ids
+    ).strip()
     prompt = "/*\n" + table_str + "\n*/\n"
     question = statement
     prompt += "statement : " + question + "\n"
@@ -30,33 +38,74 @@ def select_row_build_prompt(table_text, statement, table_caption=None, num_rows=
     return prompt
 
 
-def select_row_func(sample, table_info, llm, llm_options=None, debug=False):
+def _parse_select_row_response(res):
+    try:
+        pred = re.findall(r"f_row\(\[(.*?)\]\)", res, re.S)[0].strip()
+    except Exception:
+        return None
+    pred = pred.split(", ")
+    pred = [i.strip() for i in pred]
+    pred = [i.split(" ")[-1] for i in pred]
+    pred = sorted(pred)
+    return str(pred)
+
+
+def select_row_func(
+    sample,
+    table_info,
+    llm,
+    llm_options=None,
+    debug=False,
+    early_consensus=False,
+    union_num=2,
+    num_candidate_rows=None,
+):
     table_text = table_info["table_text"]
 
     table_caption = sample["table_caption"]
     statement = sample["statement"]
 
-    prompt = "" + select_row_demo.rstrip() + "\n\n"
-    prompt += select_row_build_prompt(table_text, statement, table_caption)
-
-    responses = llm.generate_plus_with_score(prompt, options=llm_options)
+    # only show the rows most related to the statement on large tables, the
+    # LLM still picks the rows among them
+    candidate_ids = None
+    if num_candidate_rows is not None and len(table_text) - 1 > num_candidate_rows:
+        candidate_ids = get_row_index(table_text).top_k(statement, num_candidate_rows)
+        table_text = Table.from_table_text(table_text).select_rows(candidate_ids)
+
+    def _build_prompt(table_text, row_ids):
+        if candidate_ids is not None:
+            # ids in the candidate rows -> ids in the whole table
+            if row_ids is None:
+                row_ids = candidate_ids
+            else:
+                row_ids = [candidate_ids[i] for i in row_ids]
+        prompt = "" + select_row_demo.rstrip() + "\n\n"
+        prompt += select_row_build_prompt(
+            table_text, statement, table_caption, row_ids=row_ids
+        )
+        return prompt
+
+    # rows keep their ids in the whole table, so the act does not change
+    prompt = _build_prompt(
+        *fit_table(llm, llm_options, table_text, statement, _build_prompt)
+    )
+
+    if early_consensus:
+        # stop sampling once the top `union_num` answers of the act are known
+        responses = generate_until_consensus(
+            llm, prompt, llm_options, _parse_select_row_response, top_k=union_num
+        )
+    else:
+        responses = llm.generate_plus_with_score(prompt, options=llm_options)
 
     if debug:
         print(responses)
 
-    pattern_row = r"f_row\(\[(.*?)\]\)"
-
     pred_conf_dict = {}
     for res, score in responses:
-        try:
-            pred = re.findall(pattern_row, res, re.S)[0].strip()
-        except Exception:
+        pred = _parse_select_row_response(res)
+        if pred is None:
             continue
-        pred = pred.split(", ")
-        pred = [i.strip() for i in pred]
-        pred = [i.split(" ")[-1] for i in pred]
-        pred = sorted(pred)
-        pred = str(pred)
         if pred not in pred_conf_dict:
             pred_conf_dict[pred] = 0
         pred_conf_dict[pred] += np.exp(score)
@@ -68,18 +117,18 @@ def select_row_func(sample, table_info, llm, llm_options=None, debug=False):
         "parameter_and_conf": select_row_rank,
     }
 
-    sample_copy = copy.deepcopy(sample)
-    sample_copy["chain"].append(operation)
+    sample_copy = copy.copy(sample)
+    sample_copy["chain"] = sample["chain"] + [operation]
 
     return sample_copy
 
 
 def select_row_act(table_info, operation, union_num=2, skip_op=[]):
-    table_info = copy.deepcopy(table_info)
+    table_info = copy.copy(table_info)
 
     if "select_row" in skip_op:
-        failure_table_info = copy.deepcopy(table_info)
-        failure_table_info["act_chain"].append("skip f_select_row()")
+        failure_table_info = copy.copy(table_info)
+        failure_table_info["act_chain"] = table_info["act_chain"] + ["skip f_select_row()"]
         return failure_table_info
 
     def union_lists(to_union):
@@ -93,28 +142,31 @@ def select_row_act(table_info, operation, union_num=2, skip_op=[]):
     selected_rows = union_lists(selected_rows)
 
     if "*" in selected_rows:
-        failure_table_info = copy.deepcopy(table_info)
-        failure_table_info["act_chain"].append("f_select_row(*)")
+        failure_table_info = copy.copy(table_info)
+        failure_table_info["act_chain"] = table_info["act_chain"] + ["f_select_row(*)"]
         return failure_table_info
 
     real_selected_rows = []
 
-    table_text = table_info["table_text"]
-    new_table = [copy.deepcopy(table_text[0])]
-    for row_id, row in enumerate(table_text):
-        row_id = str(row_id)
+    # "row 1" in the prompt is the first row after the header
+    table_text = Table.from_table_text(table_info["table_text"])
+    row_indices = []
+    for row_index in range(table_text.num_rows):
+        row_id = str(row_index + 1)
         if row_id in selected_rows:
-            new_table.append(copy.deepcopy(row))
+            row_indices.append(row_index)
             real_selected_rows.append(row_id)
 
-    if len(new_table) == 1:
-        failure_table_info = copy.deepcopy(table_info)
-        failure_table_info["act_chain"].append("f_select_row(*)")
+    if len(row_indices) == 0:
+        failure_table_info = copy.copy(table_info)
+        failure_table_info["act_chain"] = table_info["act_chain"] + ["f_select_row(*)"]
         return failure_table_info
 
-    table_info["table_text"] = new_table
+    table_info["table_text"] = table_text.select_rows(row_indices)
     selected_row_names = [f"row {x+1}" for x in range(len(real_selected_rows))]
-    table_info["act_chain"].append(f"f_select_row({', '.join(selected_row_names)})")
+    table_info["act_chain"] = table_info["act_chain"] + [
+        f"f_select_row({', '.join(selected_row_names)})"
+    ]
 
     _real_selected_row_names = [f"row {x-1}" for x in map(int, real_selected_rows)]
     table_info['_real_select_rows'] = f"f_select_row({', '.join(_real_selected_row_names)})"
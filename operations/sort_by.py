@@ -17,6 +17,12 @@ import copy
 import re
 import numpy as np
 from utils.helper import table2string
+from utils.table import Table
+from utils.table_backend import get_table_backend
+from utils.profile import column_profile, get_infeasible_operations
+
+# moved to utils.profile, still importable from here for existing callers
+from utils.profile import only_keep_num_and_first_dot  # noqa: F401
 
 
 sort_column_demo = """To tell the statement is true or false, we can first use f_sort() to sort the values in a column to get the order of the items. The order can be "large to small" or "small to large".
@@ -49,29 +55,6 @@ Explanation: the statement wants to check babin had the least amount of tackles
 Therefore, the answer is: f_sort(tackles), the order is "small to large"."""
 
 
-def only_keep_num_and_first_dot(s):
-    if s.strip() and s.strip()[0] == "-":
-        minus = True
-    else:
-        minus = False
-    ns = ""
-    dot = False
-    for c in s:
-        if c in "0123456789":
-            ns += c
-        if c == ".":
-            if dot == False:
-                ns += c
-                dot = True
-    if ns == ".":
-        return ""
-    if ns == "":
-        return ""
-    if minus:
-        ns = "-" + ns
-    return ns
-
-
 def sort_column_build_prompt(table_text, statement, table_caption=None, num_rows=100):
     table_str = table2string(
         table_text, caption=table_caption, num_rows=num_rows
@@ -84,11 +67,84 @@ def sort_column_build_prompt(table_text, statement, table_caption=None, num_rows
     return prompt
 
 
+def _sort_column(table_text, index, sort_order, datatype, backend="python"):
+    # (index_order, max_v, min_v) of a sort, None if the column is already sorted
+    table_backend = get_table_backend(table_text, backend)
+    if table_backend is not None:
+        numerical = datatype == "Numerical"
+        order, vs, missing = table_backend.sort_order(index, numerical)
+        reversed_order = table_backend.sort_order(index, numerical, reverse=True)[0]
+        #  check if already sorted
+        if order == sorted(order) or reversed_order == sorted(reversed_order):
+            return None
+        if sort_order != "small to large":
+            order = reversed_order
+        return order + missing, vs[-1], vs[0]
+
+    profile = column_profile(table_text, index)
+    sort_column_contents = profile["values"]
+
+    vs_to_sort = []
+    vs_not_to_sort = []
+    if datatype == "Numerical":
+        numeric = profile["numeric"].tolist()
+        for i in range(len(sort_column_contents)):
+            if not profile["number_mask"][i]:
+                vs_not_to_sort.append((sort_column_contents[i], i))
+            else:
+                vs_to_sort.append((numeric[i], i))
+    else:
+        for i in range(len(sort_column_contents)):
+            v_str = sort_column_contents[i]
+            v_str = v_str.strip()
+            if v_str == "":
+                vs_not_to_sort.append((sort_column_contents[i], i))
+            else:
+                vs_to_sort.append((v_str, i))
+
+    #  check if already sorted
+    pure_vs_to_sort = [x[0] for x in vs_to_sort]
+    if (
+        sorted(pure_vs_to_sort) == pure_vs_to_sort
+        or sorted(pure_vs_to_sort, reverse=True) == pure_vs_to_sort
+    ):
+        return None
+
+    # get sorted index
+    if sort_order == "small to large":
+        vs_to_sort = sorted(vs_to_sort, key=lambda x: x[0])
+    else:
+        vs_to_sort = sorted(vs_to_sort, reverse=True, key=lambda x: x[0])
+    index_order = [x[1] for x in vs_to_sort] + [x[1] for x in vs_not_to_sort]
+    return (
+        index_order,
+        max([x[0] for x in vs_to_sort]),
+        min([x[0] for x in vs_to_sort]),
+    )
+
+
 def sort_column_func(
-    sample, table_info, llm, llm_options=None, debug=False, skip_op=[]
+    sample,
+    table_info,
+    llm,
+    llm_options=None,
+    debug=False,
+    skip_op=[],
+    backend="python",
 ):
     # table_info = get_table_info(sample, skip_op=skip_op)
-    table_text = table_info["table_text"]
+    table_text = Table.from_table_text(table_info["table_text"])
+
+    if "sort_column" in get_infeasible_operations(table_text):
+        # every numerical column is already sorted, do not ask the LLM
+        operation = {
+            "operation_name": "sort_column",
+            "parameter_and_conf": [],
+            "infeasible": True,
+        }
+        sample_copy = copy.copy(sample)
+        sample_copy["chain"] = sample["chain"] + [operation]
+        return sample_copy
 
     statement = sample["statement"]
     prompt = "" + sort_column_demo.rstrip() + "\n\n"
@@ -105,7 +161,6 @@ def sort_column_func(
     sort_info_and_conf = {}
 
     headers = table_text[0]
-    rows = table_text[1:]
     for res, score in responses:
         try:
             datatype = re.findall(r"The datatype is (\w*).", res, re.S)[0].strip()
@@ -125,44 +180,11 @@ def sort_column_func(
 
     sort_param_and_conf_list = []
     for (sort_column, sort_order, datatype), conf in sort_info_and_conf.items():
-        sort_column_contents = []
         index = headers.index(sort_column)
-        for row in rows:
-            sort_column_contents.append(row[index])
-
-        vs_to_sort = []
-        vs_not_to_sort = []
-        if datatype == "Numerical":
-            for i in range(len(sort_column_contents)):
-                v_str = sort_column_contents[i]
-                v_str = only_keep_num_and_first_dot(v_str)
-                if v_str == "" or v_str == ".":
-                    vs_not_to_sort.append((sort_column_contents[i], i))
-                else:
-                    vs_to_sort.append((float(v_str), i))
-        else:
-            for i in range(len(sort_column_contents)):
-                v_str = sort_column_contents[i]
-                v_str = v_str.strip()
-                if v_str == "":
-                    vs_not_to_sort.append((sort_column_contents[i], i))
-                else:
-                    vs_to_sort.append((v_str, i))
-
-        #  check if already sorted
-        pure_vs_to_sort = [x[0] for x in vs_to_sort]
-        if (
-            sorted(pure_vs_to_sort) == pure_vs_to_sort
-            or sorted(pure_vs_to_sort, reverse=True) == pure_vs_to_sort
-        ):
+        sort_result = _sort_column(table_text, index, sort_order, datatype, backend)
+        if sort_result is None:
             continue
-
-        # get sorted index
-        if sort_order == "small to large":
-            vs_to_sort = sorted(vs_to_sort, key=lambda x: x[0])
-        else:
-            vs_to_sort = sorted(vs_to_sort, reverse=True, key=lambda x: x[0])
-        index_order = [x[1] for x in vs_to_sort] + [x[1] for x in vs_not_to_sort]
+        index_order, max_v, min_v = sort_result
 
         sort_param_and_conf_list.append(
             (
@@ -170,8 +192,8 @@ def sort_column_func(
                 sort_order,
                 datatype,
                 index_order,
-                max([x[0] for x in vs_to_sort]),
-                min([x[0] for x in vs_to_sort]),
+                max_v,
+                min_v,
                 conf,
             )
         )
@@ -183,8 +205,8 @@ def sort_column_func(
         "parameter_and_conf": sort_param_and_conf_list,
     }
 
-    sample_copy = copy.deepcopy(sample)
-    sample_copy["chain"].append(operation)
+    sample_copy = copy.copy(sample)
+    sample_copy["chain"] = sample["chain"] + [operation]
 
     if debug:
         print(sort_param_and_conf_list)
@@ -195,10 +217,10 @@ def sort_column_func(
 def sort_column_act(
     table_info, operation, strategy="top", filter="Only Numerical", skip_op=[]
 ):
-    table_info = copy.deepcopy(table_info)
+    table_info = copy.copy(table_info)
 
-    failure_table_info = copy.deepcopy(table_info)
-    failure_table_info["act_chain"].append("skip f_sort_column()")
+    failure_table_info = copy.copy(table_info)
+    failure_table_info["act_chain"] = table_info["act_chain"] + ["skip f_sort_column()"]
 
     if "sort_column" in skip_op:
         return failure_table_info
@@ -218,14 +240,11 @@ def sort_column_act(
     else:
         raise NotImplementedError()
 
-    table_text = table_info["table_text"]
-    headers = table_text[0]
-    rows = table_text[1:]
-    new_rows = [rows[i] for i in index_order]
-    new_table_text = [headers] + new_rows
+    table_text = Table.from_table_text(table_info["table_text"])
+    new_table_text = table_text.select_rows(index_order)
 
     table_info["table_text"] = new_table_text
     table_info["sort_sub_table"] = (sort_column, max_v, min_v)
-    table_info["act_chain"].append(f"f_sort_column({sort_column})")
+    table_info["act_chain"] = table_info["act_chain"] + [f"f_sort_column({sort_column})"]
 
     return table_info
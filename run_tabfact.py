@@ -14,12 +14,18 @@
 
 
 import fire
+import json
 import os
 
 from utils.load_data import load_tabfact_dataset
 from utils.llm import ChatGPT
+from utils.cache import LLMCache
+from utils.profile import set_profile_store
+from utils.profile_store import ProfileStore
+from utils.rate_limit import RateLimiter
 from utils.helper import *
 from utils.evaluate import *
+from utils.column_linker import get_column_linker_stats
 from utils.chain import *
 from operations import *
 
@@ -31,26 +37,70 @@ def main(
     result_dir: str = "results/tabfact",
     openai_api_key: str = None,
     first_n=-1,
+    scheduler: str = "async",
+    max_steps_in_flight: int = 256,
+    max_concurrency: int = 64,
+    plan_once: bool = False,
+    speculate: bool = False,
+    early_consensus: bool = False,
+    select_row_num_candidates: int = 0,
+    column_link_threshold: float = None,
+    validate_column_link: bool = False,
+    table_backend: str = "python",
+    add_column_batch_size: int = 10,
+    induce_pattern: bool = True,
     n_proc=1,
     chunk_size=1,
+    llm_cache_path: str = "results/llm_cache.sqlite",
+    llm_cache_max_mb: int = 2048,
+    rate_limit_path: str = "results/rate_limit.sqlite",
+    profile_cache_path: str = "results/column_profiles.sqlite",
+    requests_per_minute: int = 3500,
+    tokens_per_minute: int = 180000,
 ):
+    if scheduler == "async" and (n_proc != 1 or chunk_size != 1):
+        print(
+            "Warning: --n_proc and --chunk_size are ignored by the async scheduler, "
+            "use --max_steps_in_flight or --scheduler mp"
+        )
+    if speculate and scheduler != "loop":
+        raise ValueError("--speculate is only supported with --scheduler loop")
     dataset = load_tabfact_dataset(dataset_path, raw2clean_path, first_n=first_n)
+    llm_cache = None
+    if llm_cache_path:
+        llm_cache = LLMCache(llm_cache_path, max_bytes=llm_cache_max_mb * 1024 * 1024)
+    rate_limiter = None
+    if rate_limit_path:
+        rate_limiter = RateLimiter(
+            rate_limit_path,
+            requests_per_minute=requests_per_minute,
+            tokens_per_minute=tokens_per_minute,
+        )
+    profile_store = None
+    if profile_cache_path:
+        profile_store = ProfileStore(profile_cache_path)
+        set_profile_store(profile_store)
     gpt_llm = ChatGPT(
         model_name=model_name,
         key=os.environ["OPENAI_API_KEY"] if openai_api_key is None else openai_api_key,
+        max_concurrency=max_concurrency,
+        cache=llm_cache,
+        rate_limiter=rate_limiter,
     )
     os.makedirs(result_dir, exist_ok=True)
 
-    proc_samples, dynamic_chain_log_list = dynamic_chain_exec_with_cache_mp(
-        dataset,
-        llm=gpt_llm,
-        llm_options=gpt_llm.get_model_options(
-            temperature=0.0, per_example_max_decode_steps=200, per_example_top_p=1.0
-        ),
-        strategy="top",
-        cache_dir=os.path.join(result_dir, "cache"),
-        n_proc=n_proc,
-        chunk_size=chunk_size,
+    dynamic_chain_llm_options = gpt_llm.get_model_options(
+        temperature=0.0, per_example_max_decode_steps=200, per_example_top_p=1.0
+    )
+    operation_parameter_dict = get_operation_parameter_dict(
+        gpt_llm,
+        early_consensus=early_consensus,
+        select_row_num_candidates=select_row_num_candidates,
+        column_link_threshold=column_link_threshold,
+        validate_column_link=validate_column_link,
+        table_backend=table_backend,
+        add_column_batch_size=add_column_batch_size,
+        induce_pattern=induce_pattern,
     )
     fixed_chain = [
         (
@@ -62,7 +112,79 @@ def main(
             ),
         ),
     ]
-    final_result, _ = fixed_chain_exec_mp(gpt_llm, proc_samples, fixed_chain)
+    if scheduler == "async":
+        # the final query of a sample runs as soon as its chain is done, and
+        # its prediction is written right away
+        predictions_file = open(os.path.join(result_dir, "predictions.jsonl"), "w")
+
+        def _write_prediction(idx, proc_sample, log, final_sample):
+            sample = dataset[idx]
+            try:
+                prediction = final_sample["chain"][-1]["parameter_and_conf"][0][0]
+                correct = tabfact_match_func(final_sample)
+            except Exception:
+                prediction, correct = None, False
+            predictions_file.write(
+                json.dumps(
+                    dict(
+                        idx=idx,
+                        id=sample["id"],
+                        statement=sample["statement"],
+                        label=sample["label"],
+                        prediction=prediction,
+                        correct=correct,
+                    )
+                )
+                + "\n"
+            )
+            predictions_file.flush()
+
+        final_result, proc_samples, dynamic_chain_log_list = fused_chain_exec_async(
+            dataset,
+            llm=gpt_llm,
+            fixed_op_list=fixed_chain,
+            llm_options=dynamic_chain_llm_options,
+            strategy="top",
+            cache_dir=os.path.join(result_dir, "cache"),
+            max_steps_in_flight=max_steps_in_flight,
+            callback=_write_prediction,
+            plan_once=plan_once,
+            operation_parameter_dict=operation_parameter_dict,
+        )
+        predictions_file.close()
+    elif scheduler == "mp":
+        # one pool for both phases
+        with ChainWorkerPool(
+            gpt_llm,
+            dataset,
+            cache_dir=os.path.join(result_dir, "cache"),
+            n_proc=n_proc,
+            operation_parameter_dict=operation_parameter_dict,
+        ) as pool:
+            proc_samples, dynamic_chain_log_list = pool.dynamic_chain_exec(
+                llm_options=dynamic_chain_llm_options,
+                strategy="top",
+                chunk_size=chunk_size,
+                plan_once=plan_once,
+            )
+            final_result, _ = pool.fixed_chain_exec(fixed_chain, chunk_size=chunk_size)
+    elif scheduler == "loop":
+        # one sample at a time, where each planner call is on the critical path
+        proc_samples, dynamic_chain_log_list = dynamic_chain_exec_with_cache_for_loop(
+            dataset,
+            llm=gpt_llm,
+            llm_options=dynamic_chain_llm_options,
+            strategy="top",
+            cache_dir=os.path.join(result_dir, "cache"),
+            plan_once=plan_once,
+            operation_parameter_dict=operation_parameter_dict,
+            speculate=speculate,
+        )
+        final_result, _ = fixed_chain_exec_mp(
+            gpt_llm, proc_samples, fixed_chain, n_proc=n_proc, chunk_size=chunk_size
+        )
+    else:
+        raise ValueError(f"Unknown scheduler: {scheduler}")
     acc = tabfact_match_func_for_samples(final_result)
     print("Accuracy:", acc)
 
@@ -78,6 +200,17 @@ def main(
         open(os.path.join(result_dir, "dynamic_chain_log_list.pkl"), "wb")
     )
 
+    # stats of the run, after the results are saved
+    print("Infeasible operations:", get_infeasible_stats(dynamic_chain_log_list))
+    if speculate:
+        print("Speculation:", get_speculation_stats(dynamic_chain_log_list))
+    if column_link_threshold is not None:
+        print("Column linker:", get_column_linker_stats(proc_samples))
+    if llm_cache is not None:
+        print("LLM cache:", llm_cache.stats())
+    if profile_store is not None:
+        print("Column profiles:", profile_store.stats())
+
 
 if __name__ == "__main__":
     fire.Fire(main)
@@ -0,0 +1,233 @@
+# Copyright 2024 The Chain-of-Table authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import hashlib
+import json
+import os
+import threading
+import time
+from multiprocessing import util
+
+from utils.storage import SQLiteStore
+
+
+class LLMCache(SQLiteStore):
+    """On-disk LLM response cache shared by all processes of a run.
+
+    Entries are keyed by a hash of (model_name, messages, options, stop) and
+    evicted in least-recently-used order once `max_entries` or `max_bytes` is
+    exceeded. The number of entries and their total size are kept up to date
+    in `llm_cache_stats`, so the table is only scanned when it is over a cap.
+    Hits are read without a write lock: their access times and the hit/miss
+    counts are buffered in memory and written with the next `set` (or every
+    `flush_every` hits).
+    """
+
+    schema = [
+        "CREATE TABLE IF NOT EXISTS llm_cache ("
+        "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+        "size INTEGER NOT NULL, last_access REAL NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS llm_cache_last_access ON llm_cache(last_access)",
+        "CREATE TABLE IF NOT EXISTS llm_cache_stats ("
+        "name TEXT PRIMARY KEY, count INTEGER NOT NULL)",
+        # running totals, counted once for caches written before they existed
+        "INSERT OR IGNORE INTO llm_cache_stats (name, count) "
+        "SELECT 'entries', (SELECT COUNT(*) FROM llm_cache) "
+        "WHERE NOT EXISTS (SELECT 1 FROM llm_cache_stats WHERE name = 'entries')",
+        "INSERT OR IGNORE INTO llm_cache_stats (name, count) "
+        "SELECT 'bytes', (SELECT COALESCE(SUM(size), 0) FROM llm_cache) "
+        "WHERE NOT EXISTS (SELECT 1 FROM llm_cache_stats WHERE name = 'bytes')",
+    ]
+
+    def __init__(self, path, max_entries=None, max_bytes=None, flush_every=256):
+        super().__init__(path)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.flush_every = flush_every
+        self.hits = 0
+        self.misses = 0
+        self._reset_pending()
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        for name in ("_pending_lock", "_pending_pid", "_touched", "_pending_counts"):
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        self._reset_pending()
+
+    def _reset_pending(self):
+        # key -> last access, and hit/miss counts not written yet
+        self._pending_lock = threading.Lock()
+        self._pending_pid = os.getpid()
+        self._touched = {}
+        self._pending_counts = {"hits": 0, "misses": 0}
+        # written when the process exits, including pool workers (which do not
+        # run atexit handlers) as long as the pool is closed, not terminated
+        util.Finalize(self, self.flush, exitpriority=10)
+
+    def _take_pending(self):
+        if self._pending_pid != os.getpid():
+            # forked: the pending updates are the parent's to write
+            self._reset_pending()
+        with self._pending_lock:
+            touched, counts = self._touched, self._pending_counts
+            self._touched = {}
+            self._pending_counts = {"hits": 0, "misses": 0}
+        return touched, counts
+
+    @staticmethod
+    def make_key(model_name, messages, options, stop, tag=None):
+        # `tag` tells apart requests that are sent identically but must not
+        # share a response, e.g. the successive draws of an early-consensus vote
+        parts = [model_name, messages, options, stop]
+        if tag is not None:
+            parts.append(tag)
+        key = json.dumps(parts, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def _add(self, conn, name, count):
+        conn.execute(
+            "INSERT INTO llm_cache_stats (name, count) VALUES (?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET count = count + excluded.count",
+            (name, count),
+        )
+
+    def _write_pending(self, conn):
+        # in a write transaction
+        touched, counts = self._take_pending()
+        conn.executemany(
+            "UPDATE llm_cache SET last_access = MAX(last_access, ?) WHERE key = ?",
+            [(last_access, key) for key, last_access in touched.items()],
+        )
+        for name, count in counts.items():
+            if count:
+                self._add(conn, name, count)
+
+    def flush(self):
+        if self._pending_pid != os.getpid():
+            # forked: the pending updates are the parent's to write
+            self._reset_pending()
+            return
+        with self._pending_lock:
+            if not self._touched and not any(self._pending_counts.values()):
+                return
+        conn = self._get_conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            self._write_pending(conn)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def get(self, key):
+        row = (
+            self._get_conn()
+            .execute("SELECT value FROM llm_cache WHERE key = ?", (key,))
+            .fetchone()
+        )
+        if self._pending_pid != os.getpid():
+            self._reset_pending()
+        with self._pending_lock:
+            if row is None:
+                self._pending_counts["misses"] += 1
+            else:
+                self._touched[key] = time.time()
+                self._pending_counts["hits"] += 1
+            num_pending = len(self._touched)
+        if num_pending >= self.flush_every:
+            self.flush()
+
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return [(text, score) for text, score in json.loads(row[0])]
+
+    def set(self, key, results):
+        value = json.dumps(
+            [(text, float(score)) for text, score in results], ensure_ascii=False
+        )
+        conn = self._get_conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            old = conn.execute(
+                "SELECT size FROM llm_cache WHERE key = ?", (key,)
+            ).fetchone()
+            conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, value, size, last_access) "
+                "VALUES (?, ?, ?, ?)",
+                (key, value, len(value), time.time()),
+            )
+            if old is None:
+                self._add(conn, "entries", 1)
+                self._add(conn, "bytes", len(value))
+            else:
+                self._add(conn, "bytes", len(value) - old[0])
+            self._write_pending(conn)
+            self._evict(conn)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _totals(self, conn):
+        counts = dict(conn.execute("SELECT name, count FROM llm_cache_stats"))
+        return counts.get("entries", 0), counts.get("bytes", 0)
+
+    def _evict(self, conn):
+        if self.max_entries is None and self.max_bytes is None:
+            return
+        num_entries, num_bytes = self._totals(conn)
+
+        to_delete = []
+        if self.max_entries is not None and num_entries > self.max_entries:
+            excess_entries = num_entries - self.max_entries
+        else:
+            excess_entries = 0
+        if self.max_bytes is not None and num_bytes > self.max_bytes:
+            excess_bytes = num_bytes - self.max_bytes
+        else:
+            excess_bytes = 0
+        if excess_entries == 0 and excess_bytes == 0:
+            return
+
+        deleted_bytes = 0
+        for key, size in conn.execute(
+            "SELECT key, size FROM llm_cache ORDER BY last_access"
+        ):
+            if len(to_delete) >= excess_entries and deleted_bytes >= excess_bytes:
+                break
+            to_delete.append(key)
+            deleted_bytes += size
+        conn.executemany(
+            "DELETE FROM llm_cache WHERE key = ?", [(key,) for key in to_delete]
+        )
+        self._add(conn, "entries", -len(to_delete))
+        self._add(conn, "bytes", -deleted_bytes)
+
+    def stats(self):
+        self.flush()
+        conn = self._get_conn()
+        counts = dict(conn.execute("SELECT name, count FROM llm_cache_stats"))
+        return {
+            "hits": counts.get("hits", 0),
+            "misses": counts.get("misses", 0),
+            "entries": counts.get("entries", 0),
+            "bytes": counts.get("bytes", 0),
+        }
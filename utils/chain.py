@@ -13,12 +13,25 @@
 # limitations under the License.
 
 
+import asyncio
 import copy
+import functools
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 import numpy as np
 from utils.helper import table2string
-from collections import defaultdict
+from utils.table import Table, table_fingerprint
+from utils.profile import (
+    get_infeasible_operations,
+    get_profile_store,
+    load_column_profiles,
+    set_profile_store,
+)
+from utils.result_store import ResultStore
+from utils.token_budget import fit_table
+from collections import defaultdict, OrderedDict
 import pickle
 import os
 
@@ -31,7 +44,7 @@ def fixed_chain_exec_mp(llm, init_samples, fixed_op_list, n_proc=10, chunk_size=
     history = {}
     final_result = None
 
-    chain_header = copy.deepcopy(init_samples)
+    chain_header = list(init_samples)
     chain_key = ""
 
     for i, (op_name, solver_func, kargs, llm_kargs) in enumerate(fixed_op_list):
@@ -100,13 +113,20 @@ def conduct_single_solver_mp(
         for idx, sample in enumerate(all_samples)
     ]
 
-    with mp.Pool(n_proc) as p:
+    with mp.Pool(
+        n_proc,
+        initializer=_init_worker,
+        initargs=(get_profile_store(), fit_table_info_cache(all_samples)),
+    ) as p:
         for idx, proc_sample in tqdm(
             p.imap_unordered(_conduct_single_solver_mp_core, args, chunksize=chunk_size),
             total=len(all_samples),
             desc=tqdm_tag,
         ):
             result_samples[idx] = proc_sample
+        # close rather than terminate, so that the workers run their finalizers
+        p.close()
+        p.join()
 
     return result_samples
 
@@ -116,30 +136,99 @@ def get_act_func(name):
         return eval(f"{name}_act")
     except:
 
-        def _default_act(table_text, *args, **kwargs):
-            return copy.deepcopy(table_text)
+        def _default_act(table_info, *args, **kwargs):
+            table_info = copy.copy(table_info)
+            table_info["act_chain"] = list(table_info["act_chain"])
+            return table_info
 
         if "query" not in name:
             print("Unknown operation: ", name)
         return _default_act
 
 
+# Materialized table_info of every chain prefix, so that extending a chain
+# only applies the new operation. Keyed by (table fingerprint, skip_op), then
+# by the chain prefix; samples on the same table share their prefixes, down to
+# the Table object of the original table and everything memoized on it.
+_table_info_cache = OrderedDict()
+_table_info_cache_lock = threading.Lock()
+TABLE_INFO_CACHE_SIZE = 256
+_table_info_cache_size = TABLE_INFO_CACHE_SIZE
+
+
+def set_table_info_cache_size(size):
+    global _table_info_cache_size
+    _table_info_cache_size = max(size, TABLE_INFO_CACHE_SIZE)
+
+
+def fit_table_info_cache(all_samples):
+    # The schedulers interleave the samples of a run, so the cache holds every
+    # table of the run: otherwise prefixes still in use get evicted. Returns
+    # the size, for the initializers of pool workers.
+    fingerprints = {
+        sample.get("table_fingerprint") or table_fingerprint(sample["table_text"])
+        for sample in all_samples
+        if sample is not None
+    }
+    set_table_info_cache_size(len(fingerprints))
+    return _table_info_cache_size
+
+
+def _init_worker(profile_store, table_info_cache_size):
+    # spawned workers do not inherit the state of this process
+    set_profile_store(profile_store)
+    set_table_info_cache_size(table_info_cache_size)
+
+
 def get_table_info(sample, skip_op=[], first_n_op=None):
+    # The returned table_info may be shared with other callers and must not be
+    # modified in place.
     table_text = sample["table_text"]
     chain = sample["chain"]
 
     if first_n_op is not None:
         chain = chain[:first_n_op]
 
-    table_info = {
-        "table_text": table_text,
-        "act_chain": [],
-    }
+    fingerprint = sample.get("table_fingerprint") or table_fingerprint(table_text)
+    cache_key = (fingerprint, tuple(skip_op))
+    op_keys = tuple(repr(operation) for operation in chain)
+
+    with _table_info_cache_lock:
+        prefix_cache = _table_info_cache.get(cache_key)
+        if prefix_cache is None:
+            prefix_cache = {}
+            _table_info_cache[cache_key] = prefix_cache
+            if len(_table_info_cache) > _table_info_cache_size:
+                _table_info_cache.popitem(last=False)
+        else:
+            _table_info_cache.move_to_end(cache_key)
 
-    for operation in chain:
+        start = None
+        for n in range(len(op_keys), -1, -1):
+            if op_keys[:n] in prefix_cache:
+                start = n
+                table_info = prefix_cache[op_keys[:n]]
+                break
+
+    if start is None:
+        start = 0
+        table = Table.from_table_text(table_text)
+        # profiles of the dataset tables may be stored by a previous run
+        load_column_profiles(table, fingerprint)
+        table_info = {
+            "table_text": table,
+            "act_chain": [],
+        }
+        with _table_info_cache_lock:
+            table_info = prefix_cache.setdefault((), table_info)
+
+    for n in range(start, len(chain)):
+        operation = chain[n]
         operation_name = operation["operation_name"]
         act_func = get_act_func(operation_name)
         table_info = act_func(table_info, operation, skip_op=skip_op)
+        with _table_info_cache_lock:
+            prefix_cache[op_keys[: n + 1]] = table_info
 
     return table_info
 
@@ -330,69 +419,145 @@ def get_all_operation_names(string):
     return operation_names
 
 
+def get_next_operation_candidates(act_chain, table_text=None):
+    # With `table_text`, operations that are infeasible on the table (see
+    # get_infeasible_operations) are not candidates either.
+    kept_act_chain = [x for x in act_chain if not x.startswith("skip")]
+
+    skip_act_chain = [x for x in act_chain if x.startswith("skip")]
+    skip_act_chain_op_names = []
+    for op in skip_act_chain:
+        op = op[len("skip ") :]
+        op_name = get_operation_name(op)
+        skip_act_chain_op_names.append(op_name)
+
+    last_operation = (
+        "<init>" if not kept_act_chain else get_operation_name(kept_act_chain[-1])
+    )
+    possible_next_operations = possible_next_operation_dict[last_operation]
+    possible_next_operations = [
+        x for x in possible_next_operations if x not in skip_act_chain_op_names
+    ]
+    infeasible_operations = []
+    if table_text is not None:
+        infeasible_operations = [
+            x
+            for x in get_infeasible_operations(Table.from_table_text(table_text))
+            if x in possible_next_operations
+        ]
+        possible_next_operations = [
+            x for x in possible_next_operations if x not in infeasible_operations
+        ]
+    return (
+        kept_act_chain,
+        skip_act_chain_op_names,
+        last_operation,
+        possible_next_operations,
+        infeasible_operations,
+    )
+
+
+def get_remaining_plan(responses, next_operation, skip_op_names=[]):
+    # The operations that the planner predicted after `next_operation`, cut at
+    # the first one that cannot follow its predecessor.
+    for response, _ in responses:
+        generate_operations = get_all_operation_names(response)
+        if next_operation not in generate_operations:
+            continue
+        plan = []
+        last_operation = next_operation
+        start = generate_operations.index(next_operation) + 1
+        for operation in generate_operations[start:]:
+            if operation not in possible_next_operation_dict.get(last_operation, []):
+                break
+            if operation in skip_op_names:
+                break
+            plan.append(operation)
+            last_operation = operation
+        return plan
+    return []
+
+
 def generate_prompt_for_next_step(
     sample,
     debug=False,
     llm=None,
     llm_options=None,
     strategy="top",
+    plan_once=False,
 ):
+    # With `plan_once`, the rest of the predicted Function Chain is kept in
+    # sample["plan"] and followed without asking the planner again, until an
+    # operation is skipped or the next planned operation is not possible.
     table_info = get_table_info(sample)
     act_chain = table_info["act_chain"]
 
     if debug:
         print("Act Chain: ", act_chain, flush=True)
 
-    kept_act_chain = [x for x in act_chain if not x.startswith("skip")]
+    (
+        kept_act_chain,
+        skip_act_chain_op_names,
+        last_operation,
+        possible_next_operations,
+        infeasible_operations,
+    ) = get_next_operation_candidates(act_chain, table_info["table_text"])
     kept_act_chain_str = " -> ".join(kept_act_chain)
     if kept_act_chain_str:
         kept_act_chain_str += " ->"
 
-    skip_act_chain = [x for x in act_chain if x.startswith("skip")]
-    skip_act_chain_op_names = []
-    for op in skip_act_chain:
-        op = op[len("skip ") :]
-        op_name = get_operation_name(op)
-        skip_act_chain_op_names.append(op_name)
-
     if debug:
         print("Kept Act Chain: ", kept_act_chain, flush=True)
-        print("Skip Act Chain: ", skip_act_chain, flush=True)
-
-    last_operation = (
-        "<init>" if not kept_act_chain else get_operation_name(kept_act_chain[-1])
-    )
-    possible_next_operations = possible_next_operation_dict[last_operation]
-    possible_next_operations = [
-        x for x in possible_next_operations if x not in skip_act_chain_op_names
-    ]
+        print("Skip Act Chain: ", skip_act_chain_op_names, flush=True)
 
     if debug:
         print("Last Operation: ", last_operation, flush=True)
         print("Possible Next Operations: ", possible_next_operations, flush=True)
+        print("Infeasible Operations: ", infeasible_operations, flush=True)
+
+    plan = sample.get("plan") if plan_once else None
+    if plan and act_chain and act_chain[-1].startswith("skip"):
+        # the last operation was skipped, so the plan is based on a table
+        # that does not exist
+        plan = None
+    if plan and plan[0] in possible_next_operations:
+        log = {
+            "act_chain": act_chain,
+            "last_operation": last_operation,
+            "possible_next_operations": possible_next_operations,
+            "infeasible_operations": infeasible_operations,
+            "prompt": None,
+            "response": None,
+            "generate_operations": plan,
+            "next_operation": plan[0],
+            "plan": plan[1:],
+        }
+        return plan[0], log
 
     if len(possible_next_operations) == 1:
         log = {
             "act_chain": act_chain,
             "last_operation": last_operation,
             "possible_next_operations": possible_next_operations,
+            "infeasible_operations": infeasible_operations,
             "prompt": None,
             "response": None,
             "generate_operations": None,
             "next_operation": possible_next_operations[0],
         }
+        if plan_once:
+            log["plan"] = []
         return possible_next_operations[0], log
 
-    prompt = ""
+    prompt_prefix = ""
     for operation in possible_next_operations:
         if operation == "<END>":
             continue
-        prompt += eval(f"plan_{operation}_demo") + "\n\n"
+        prompt_prefix += eval(f"plan_{operation}_demo") + "\n\n"
 
-    prompt += plan_full_demo_simple + "\n\n"
+    prompt_prefix += plan_full_demo_simple + "\n\n"
 
-    prompt += "/*\n" + table2string(table_info["table_text"]) + "\n*/\n"
-    prompt += "Statement: " + sample["statement"] + "\n"
+    prompt = "Statement: " + sample["statement"] + "\n"
 
     _possible_next_operations_str = " or ".join(
         [f"f_{op}()" if op != "<END>" else op for op in possible_next_operations]
@@ -407,6 +572,20 @@ def generate_prompt_for_next_step(
 
     prompt += "Function Chain: " + kept_act_chain_str
 
+    def _build_prompt(table_text, row_ids):
+        table_str = table2string(table_text, row_ids=row_ids)
+        return prompt_prefix + "/*\n" + table_str + "\n*/\n" + prompt
+
+    prompt = _build_prompt(
+        *fit_table(
+            llm,
+            llm_options,
+            table_info["table_text"],
+            sample["statement"],
+            _build_prompt,
+        )
+    )
+
     responses = llm.generate_plus_with_score(
         prompt, options=llm_options, end_str="\n\n"
     )
@@ -446,15 +625,260 @@ def generate_prompt_for_next_step(
         "act_chain": act_chain,
         "last_operation": last_operation,
         "possible_next_operations": possible_next_operations,
+        "infeasible_operations": infeasible_operations,
         "prompt": prompt,
         "response": response,
         "generate_operations": generate_operations,
         "next_operation": next_operation,
     }
+    if plan_once:
+        log["plan"] = get_remaining_plan(
+            responses, next_operation, skip_act_chain_op_names
+        )
 
     return next_operation, log
 
 
+def get_operation_parameter_dict(
+    llm,
+    early_consensus=False,
+    select_row_num_candidates=None,
+    column_link_threshold=None,
+    validate_column_link=False,
+    table_backend="python",
+    add_column_batch_size=10,
+    induce_pattern=True,
+):
+    # With `early_consensus`, select_row and select_column draw their samples
+    # one by one and stop once the rows/columns they select are decided.
+    select_kargs = dict(early_consensus=True) if early_consensus else {}
+    select_row_kargs = dict(select_kargs)
+    if select_row_num_candidates:
+        # larger tables only show their top rows for the statement to select_row
+        select_row_kargs["num_candidate_rows"] = select_row_num_candidates
+    select_column_kargs = dict(select_kargs)
+    if column_link_threshold is not None:
+        # confident links of the statement to the columns skip the LLM
+        select_column_kargs["link_threshold"] = column_link_threshold
+        select_column_kargs["validate_link"] = validate_column_link
+    table_kargs = dict(skip_op=[])
+    if table_backend != "python":
+        # group_column and sort_column run as queries on a copy of the table,
+        # see utils/table_backend.py
+        table_kargs["backend"] = table_backend
+    # rows of add_column are extracted `add_column_batch_size` at a time (1 is
+    # one request per row), after trying to induce a pattern from the first 3
+    add_column_kargs = dict(
+        batch_size=add_column_batch_size, induce_pattern=induce_pattern
+    )
+    return {
+        "add_column": (
+            "addColumn",
+            add_column_func,
+            add_column_kargs,
+            llm.get_model_options(
+                temperature=0.0,
+                per_example_max_decode_steps=150,
+                per_example_top_p=1.0,
+            ),
+        ),
+        "select_row": (
+            "selectRow",
+            select_row_func,
+            select_row_kargs,
+            llm.get_model_options(
+                temperature=0.5,
+                per_example_max_decode_steps=150,
+                per_example_top_p=1.0,
+                n_sample=8,
+            ),
+        ),
+        "select_column": (
+            "selectColumn",
+            select_column_func,
+            select_column_kargs,
+            llm.get_model_options(
+                temperature=0.5,
+                per_example_max_decode_steps=150,
+                per_example_top_p=1.0,
+                n_sample=8,
+            ),
+        ),
+        "group_column": (
+            "groupColumn",
+            group_column_func,
+            table_kargs,
+            llm.get_model_options(
+                temperature=0.0,
+                per_example_max_decode_steps=150,
+                per_example_top_p=1.0,
+            ),
+        ),
+        "sort_column": (
+            "sortColumn",
+            sort_column_func,
+            table_kargs,
+            llm.get_model_options(
+                temperature=0.0,
+                per_example_max_decode_steps=150,
+                per_example_top_p=1.0,
+            ),
+        ),
+    }
+
+
+# Most frequent next operation in the planner logs, used to guess which
+# operation to run speculatively before the planner has answered
+likely_next_operation_dict = {
+    "<init>": "add_column",
+    "add_column": "select_row",
+    "select_row": "select_column",
+    "select_column": "<END>",
+    "group_column": "<END>",
+    "sort_column": "<END>",
+}
+
+# transitions chosen by the planner in this process, which override the
+# defaults above once observed
+_observed_transitions = defaultdict(lambda: defaultdict(int))
+_observed_transitions_lock = threading.Lock()
+_speculation_executor = ThreadPoolExecutor(max_workers=32)
+
+
+def predict_next_operation(last_operation, possible_next_operations):
+    with _observed_transitions_lock:
+        counts = dict(_observed_transitions[last_operation])
+    counts = {k: v for k, v in counts.items() if k in possible_next_operations}
+    if counts:
+        return max(counts.items(), key=lambda x: x[1])[0]
+    next_operation = likely_next_operation_dict.get(last_operation)
+    if next_operation in possible_next_operations:
+        return next_operation
+    return None
+
+
+def _start_speculation(current_sample, llm, operation_parameter_dict, plan_once):
+    # Start the solver of the likely next operation, so that it runs at the same
+    # time as the planner. Returns (operation, future) or None.
+    table_info = get_table_info(current_sample)
+    act_chain = table_info["act_chain"]
+    _, _, last_operation, possible_next_operations, _ = get_next_operation_candidates(
+        act_chain, table_info["table_text"]
+    )
+    if len(possible_next_operations) <= 1:
+        # no planner call to overlap with
+        return None
+    plan = current_sample.get("plan") if plan_once else None
+    if plan and not act_chain[-1].startswith("skip"):
+        if plan[0] in possible_next_operations:
+            return None
+
+    operation = predict_next_operation(last_operation, possible_next_operations)
+    if operation is None or operation == "<END>":
+        return None
+    op_name, solver_func, kargs, op_llm_options = operation_parameter_dict[operation]
+    future = _speculation_executor.submit(
+        solver_func,
+        current_sample,
+        table_info,
+        llm=llm,
+        llm_options=copy.copy(op_llm_options),
+        **kargs,
+    )
+    return operation, future
+
+
+def get_infeasible_stats(dynamic_chain_log_list):
+    # how often each operation was left out of the planner candidates because
+    # it could not change the table
+    counts = defaultdict(int)
+    for dynamic_chain_log in dynamic_chain_log_list:
+        for log in dynamic_chain_log or []:
+            for operation in log.get("infeasible_operations", []):
+                counts[operation] += 1
+    return dict(counts)
+
+
+def get_speculation_stats(dynamic_chain_log_list):
+    # hit rate of speculative execution over the logs of a run
+    num_hits = num_speculations = 0
+    for dynamic_chain_log in dynamic_chain_log_list:
+        for log in dynamic_chain_log or []:
+            if log.get("speculated_operation") is not None:
+                num_speculations += 1
+                num_hits += log["speculation_hit"]
+    return {
+        "speculations": num_speculations,
+        "hits": num_hits,
+        "hit_rate": num_hits / num_speculations if num_speculations else 0.0,
+    }
+
+
+def dynamic_chain_exec_step(
+    current_sample,
+    llm,
+    llm_options=None,
+    strategy="top",
+    debug=False,
+    operation_parameter_dict=None,
+    plan_once=False,
+    speculate=False,
+):
+    # One step of a dynamic chain: plan the next operation and, unless it is
+    # <END>, run it. Returns the new sample (None once the chain is finished)
+    # and the planner log of the step.
+    # With `speculate`, the likely next operation runs while the planner call
+    # is in flight; its result is used if the planner picks the same operation
+    # and thrown away otherwise. This trades tokens for latency, the results
+    # are the same.
+    if operation_parameter_dict is None:
+        operation_parameter_dict = get_operation_parameter_dict(llm)
+
+    speculation = None
+    if speculate:
+        speculation = _start_speculation(
+            current_sample, llm, operation_parameter_dict, plan_once
+        )
+
+    # generate next operation
+    next_operation, log = generate_prompt_for_next_step(
+        current_sample,
+        llm=llm,
+        llm_options=llm_options,
+        strategy=strategy,
+        debug=debug,
+        plan_once=plan_once,
+    )
+
+    if debug:
+        print(next_operation)
+
+    if log["prompt"] is not None:
+        with _observed_transitions_lock:
+            _observed_transitions[log["last_operation"]][next_operation] += 1
+    if speculation is not None:
+        log["speculated_operation"] = speculation[0]
+        log["speculation_hit"] = speculation[0] == next_operation
+
+    if next_operation == "<END>":
+        return None, log
+
+    param = operation_parameter_dict[next_operation]
+    op_name, solver_func, kargs, op_llm_options = param
+
+    table_info = get_table_info(current_sample)
+
+    if speculation is not None and log["speculation_hit"]:
+        current_sample = speculation[1].result()
+    else:
+        current_sample = solver_func(
+            current_sample, table_info, llm=llm, llm_options=op_llm_options, **kargs
+        )
+    if plan_once:
+        current_sample["plan"] = log["plan"]
+    return current_sample, log
+
+
 def dynamic_chain_exec_one_sample(
     sample,
     llm,
@@ -462,92 +886,86 @@ def dynamic_chain_exec_one_sample(
     strategy="top",
     debug=False,
     operation_parameter_dict=None,
+    checkpoint=None,
+    plan_once=False,
+    speculate=False,
 ):
+    # `checkpoint` (a StepCheckpoint) saves the chain after every operation and
+    # resumes it from the last completed one
     if operation_parameter_dict is None:
-        operation_parameter_dict = {
-            "add_column": (
-                "addColumn",
-                add_column_func,
-                {},
-                llm.get_model_options(
-                    temperature=0.0,
-                    per_example_max_decode_steps=150,
-                    per_example_top_p=1.0,
-                ),
-            ),
-            "select_row": (
-                "selectRow",
-                select_row_func,
-                {},
-                llm.get_model_options(
-                    temperature=0.5,
-                    per_example_max_decode_steps=150,
-                    per_example_top_p=1.0,
-                    n_sample=8,
-                ),
-            ),
-            "select_column": (
-                "selectColumn",
-                select_column_func,
-                {},
-                llm.get_model_options(
-                    temperature=0.5,
-                    per_example_max_decode_steps=150,
-                    per_example_top_p=1.0,
-                    n_sample=8,
-                ),
-            ),
-            "group_column": (
-                "groupColumn",
-                group_column_func,
-                dict(skip_op=[]),
-                llm.get_model_options(
-                    temperature=0.0,
-                    per_example_max_decode_steps=150,
-                    per_example_top_p=1.0,
-                ),
-            ),
-            "sort_column": (
-                "sortColumn",
-                sort_column_func,
-                dict(skip_op=[]),
-                llm.get_model_options(
-                    temperature=0.0,
-                    per_example_max_decode_steps=150,
-                    per_example_top_p=1.0,
-                ),
-            ),
-        }
+        operation_parameter_dict = get_operation_parameter_dict(llm)
 
     dynamic_chain_log = []
 
-    current_sample = copy.deepcopy(sample)
+    current_sample = copy.copy(sample)
+    if checkpoint is not None:
+        state = checkpoint.load()
+        if state is not None:
+            current_sample, dynamic_chain_log = state
     while True:
-        # generate next operation
-        next_operation, log = generate_prompt_for_next_step(
+        next_sample, log = dynamic_chain_exec_step(
             current_sample,
-            llm=llm,
+            llm,
             llm_options=llm_options,
             strategy=strategy,
             debug=debug,
+            operation_parameter_dict=operation_parameter_dict,
+            plan_once=plan_once,
+            speculate=speculate,
         )
         dynamic_chain_log.append(log)
 
-        if debug:
-            print(next_operation)
-
-        if next_operation == "<END>":
+        if next_sample is None:
             break
+        current_sample = next_sample
+        if checkpoint is not None:
+            checkpoint.save(current_sample, dynamic_chain_log)
+    return current_sample, dynamic_chain_log
 
-        param = operation_parameter_dict[next_operation]
+
+def get_result_store(cache_dir):
+    return ResultStore(os.path.join(cache_dir, "results.sqlite"))
+
+
+def get_dynamic_chain_config(
+    llm, llm_options, strategy, plan_once=False, operation_parameter_dict=None
+):
+    # everything besides the sample that changes the result of a chain
+    if operation_parameter_dict is None:
+        operation_parameter_dict = get_operation_parameter_dict(llm)
+    operations = {}
+    for name, param in operation_parameter_dict.items():
         op_name, solver_func, kargs, op_llm_options = param
+        operations[name] = (op_name, kargs, op_llm_options)
+    return dict(
+        model_name=getattr(llm, "model_name", None),
+        llm_options=llm_options,
+        strategy=strategy,
+        plan_once=plan_once,
+        operations=operations,
+    )
 
-        table_info = get_table_info(current_sample)
 
-        current_sample = solver_func(
-            current_sample, table_info, llm=llm, llm_options=op_llm_options, **kargs
-        )
-    return current_sample, dynamic_chain_log
+def get_fixed_chain_tasks(llm, fixed_op_list, input_config):
+    # (op_name, solver_func, kwargs, store config of the outputs) of every
+    # operation of a fixed chain run on the results stored under `input_config`
+    tasks = []
+    chain_key = ""
+    for i, (op_name, solver_func, kargs, llm_kargs) in enumerate(fixed_op_list):
+        chain_key += f"->{op_name}" if i > 0 else op_name
+        kwargs = dict(kargs, llm_options=llm.get_model_options(**llm_kargs))
+        output_config = dict(input_config or {}, fixed_chain=chain_key, kwargs=kwargs)
+        tasks.append((op_name, solver_func, kwargs, output_config))
+    return tasks
+
+
+def _conduct_single_solver_step(sample, llm, solver_func, kwargs):
+    table_info = get_table_info(
+        sample,
+        skip_op=kwargs.get("skip_op", []),
+        first_n_op=kwargs.get("first_n_op", None),
+    )
+    return solver_func(sample, table_info, llm, **kwargs)
 
 
 def dynamic_chain_exec_with_cache_for_loop(
@@ -556,24 +974,38 @@ def dynamic_chain_exec_with_cache_for_loop(
     llm_options=None,
     strategy="voting",
     cache_dir="./cache/debug",
+    plan_once=False,
+    operation_parameter_dict=None,
+    speculate=False,
 ):
+    # `speculate` does not change the results, so it is not part of the config
     os.makedirs(cache_dir, exist_ok=True)
     result_samples = [None for _ in range(len(all_samples))]
     dynamic_chain_log_list = [None for _ in range(len(all_samples))]
 
-    cache_filename = "case-{}.pkl"
+    store = get_result_store(cache_dir)
+    config = get_dynamic_chain_config(
+        llm, llm_options, strategy, plan_once, operation_parameter_dict
+    )
 
     def _func(idx):
         sample = all_samples[idx]
-        sample_id = sample["id"]
-        cache_path = os.path.join(cache_dir, cache_filename.format(sample_id))
-        if os.path.exists(cache_path):
-            _, proc_sample, log = pickle.load(open(cache_path, "rb"))
+        key = ResultStore.make_key(sample, config)
+        cached = store.get(key)
+        if cached is not None:
+            _, proc_sample, log = cached
         else:
             proc_sample, log = dynamic_chain_exec_one_sample(
-                sample, llm=llm, llm_options=llm_options, strategy=strategy
+                sample,
+                llm=llm,
+                llm_options=llm_options,
+                strategy=strategy,
+                checkpoint=store.checkpoint(key),
+                plan_once=plan_once,
+                operation_parameter_dict=operation_parameter_dict,
+                speculate=speculate,
             )
-            pickle.dump((sample, proc_sample, log), open(cache_path, "wb"))
+            store.put(key, sample, proc_sample, log)
         result_samples[idx] = proc_sample
         dynamic_chain_log_list[idx] = log
 
@@ -586,26 +1018,67 @@ def dynamic_chain_exec_with_cache_for_loop(
     return result_samples, dynamic_chain_log_list
 
 
-def _dynamic_chain_exec_with_cache_mp_core(arg):
-    idx, sample, llm, llm_options, strategy, cache_dir = arg
-
-    cache_filename = "case-{}.pkl"
+def _dynamic_chain_exec_cached(
+    idx,
+    sample,
+    llm,
+    llm_options,
+    strategy,
+    store,
+    operation_parameter_dict=None,
+    plan_once=False,
+):
     try:
         sample_id = sample["id"]
-        cache_path = os.path.join(cache_dir, cache_filename.format(idx))
-        if os.path.exists(cache_path):
-            _, proc_sample, log = pickle.load(open(cache_path, "rb"))
+        key = ResultStore.make_key(
+            sample,
+            get_dynamic_chain_config(
+                llm, llm_options, strategy, plan_once, operation_parameter_dict
+            ),
+        )
+        cached = store.get(key)
+        if cached is not None:
+            _, proc_sample, log = cached
         else:
             proc_sample, log = dynamic_chain_exec_one_sample(
-                sample, llm=llm, llm_options=llm_options, strategy=strategy
+                sample,
+                llm=llm,
+                llm_options=llm_options,
+                strategy=strategy,
+                operation_parameter_dict=operation_parameter_dict,
+                checkpoint=store.checkpoint(key),
+                plan_once=plan_once,
             )
-            pickle.dump((sample, proc_sample, log), open(cache_path, "wb"))
+            store.put(key, sample, proc_sample, log)
         return idx, proc_sample, log
     except Exception as e:
         print(f"Error in {sample_id}: {e}", flush=True)
         return idx, None, None
 
 
+def _dynamic_chain_exec_with_cache_mp_core(arg):
+    (
+        idx,
+        sample,
+        llm,
+        llm_options,
+        strategy,
+        store,
+        plan_once,
+        operation_parameter_dict,
+    ) = arg
+    return _dynamic_chain_exec_cached(
+        idx,
+        sample,
+        llm,
+        llm_options,
+        strategy,
+        store,
+        operation_parameter_dict=operation_parameter_dict,
+        plan_once=plan_once,
+    )
+
+
 def dynamic_chain_exec_with_cache_mp(
     all_samples,
     llm,
@@ -614,17 +1087,33 @@ def dynamic_chain_exec_with_cache_mp(
     cache_dir="./results/debug",
     n_proc=10,
     chunk_size=50,
+    plan_once=False,
+    operation_parameter_dict=None,
 ):
     os.makedirs(cache_dir, exist_ok=True)
     result_samples = [None for _ in range(len(all_samples))]
     dynamic_chain_log_list = [None for _ in range(len(all_samples))]
 
+    store = get_result_store(cache_dir)
     args = [
-        (idx, sample, llm, llm_options, strategy, cache_dir)
+        (
+            idx,
+            sample,
+            llm,
+            llm_options,
+            strategy,
+            store,
+            plan_once,
+            operation_parameter_dict,
+        )
         for idx, sample in enumerate(all_samples)
     ]
 
-    with mp.Pool(n_proc) as p:
+    with mp.Pool(
+        n_proc,
+        initializer=_init_worker,
+        initargs=(get_profile_store(), fit_table_info_cache(all_samples)),
+    ) as p:
         for idx, proc_sample, log in tqdm(
             p.imap_unordered(
                 _dynamic_chain_exec_with_cache_mp_core, args, chunksize=chunk_size
@@ -633,5 +1122,445 @@ def dynamic_chain_exec_with_cache_mp(
         ):
             result_samples[idx] = proc_sample
             dynamic_chain_log_list[idx] = log
+        # close rather than terminate, so that the workers run their finalizers
+        p.close()
+        p.join()
+
+    return result_samples, dynamic_chain_log_list
+
+
+# State of a ChainWorkerPool worker, set once by the pool initializer
+_chain_worker = {}
+
+
+def _init_chain_worker(
+    llm,
+    all_samples,
+    store,
+    operation_parameter_dict,
+    profile_store=None,
+    table_info_cache_size=TABLE_INFO_CACHE_SIZE,
+):
+    _init_worker(profile_store, table_info_cache_size)
+    if operation_parameter_dict is None:
+        operation_parameter_dict = get_operation_parameter_dict(llm)
+    _chain_worker["llm"] = llm
+    _chain_worker["samples"] = all_samples
+    _chain_worker["store"] = store
+    _chain_worker["operation_parameter_dict"] = operation_parameter_dict
+
+
+def _chain_worker_dynamic_chain(arg):
+    idx, llm_options, strategy, plan_once = arg
+    return _dynamic_chain_exec_cached(
+        idx,
+        _chain_worker["samples"][idx],
+        _chain_worker["llm"],
+        llm_options,
+        strategy,
+        _chain_worker["store"],
+        operation_parameter_dict=_chain_worker["operation_parameter_dict"],
+        plan_once=plan_once,
+    )
+
+
+def _chain_worker_single_solver(arg):
+    # the input of the solver is the output of the previous phase, stored
+    # under `input_config` (or the original sample if it is None)
+    idx, input_config, output_config, solver_func, kwargs = arg
+    sample = _chain_worker["samples"][idx]
+    store = _chain_worker["store"]
+    try:
+        key = ResultStore.make_key(sample, output_config)
+        cached = store.get(key)
+        if cached is not None:
+            return idx, cached[1]
+
+        if input_config is None:
+            input_sample = sample
+        else:
+            cached = store.get(ResultStore.make_key(sample, input_config))
+            if cached is None or cached[1] is None:
+                return idx, None
+            input_sample = cached[1]
+
+        proc_sample = _conduct_single_solver_step(
+            input_sample, _chain_worker["llm"], solver_func, kwargs
+        )
+        store.put(key, sample, proc_sample, None)
+        return idx, proc_sample
+    except Exception as e:
+        print(f"Error in {idx}-th sample: {e}")
+        return idx, None
+
+
+class ChainWorkerPool:
+    """One process pool for all phases of a run.
+
+    The LLM, the samples, the result store and the operation registry are
+    given to every worker once, by the pool initializer, so tasks only carry
+    sample indices. A phase reads its inputs from the results that the
+    previous phase wrote to the store.
+    """
+
+    def __init__(
+        self,
+        llm,
+        all_samples,
+        cache_dir="./results/debug",
+        n_proc=10,
+        operation_parameter_dict=None,
+    ):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.llm = llm
+        self.num_samples = len(all_samples)
+        self.operation_parameter_dict = operation_parameter_dict
+        self.pool = mp.Pool(
+            n_proc,
+            initializer=_init_chain_worker,
+            initargs=(
+                llm,
+                all_samples,
+                get_result_store(cache_dir),
+                operation_parameter_dict,
+                get_profile_store(),
+                fit_table_info_cache(all_samples),
+            ),
+        )
+        # store config of the results of the last phase
+        self.last_config = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            # let the workers exit normally, so that they run their finalizers
+            # (e.g. LLMCache writes the hits they buffered)
+            self.pool.close()
+            self.pool.join()
+        else:
+            self.pool.terminate()
+
+    def _map(self, func, args, chunk_size, desc=None):
+        # tasks return (idx, *outputs); returns the outputs of every sample
+        results = [None for _ in range(self.num_samples)]
+        for idx, *outputs in tqdm(
+            self.pool.imap_unordered(func, args, chunksize=chunk_size),
+            total=len(args),
+            desc=desc,
+        ):
+            results[idx] = outputs
+        return results
+
+    def dynamic_chain_exec(
+        self, llm_options=None, strategy="voting", chunk_size=50, plan_once=False
+    ):
+        args = [
+            (idx, llm_options, strategy, plan_once) for idx in range(self.num_samples)
+        ]
+        results = self._map(_chain_worker_dynamic_chain, args, chunk_size)
+        self.last_config = get_dynamic_chain_config(
+            self.llm, llm_options, strategy, plan_once, self.operation_parameter_dict
+        )
+
+        result_samples = [proc_sample for proc_sample, _ in results]
+        dynamic_chain_log_list = [log for _, log in results]
+        return result_samples, dynamic_chain_log_list
+
+    def fixed_chain_exec(self, fixed_op_list, chunk_size=50):
+        # same as fixed_chain_exec_mp, on the results of the last phase
+        history = {}
+        final_result = None
+
+        fixed_chain_tasks = get_fixed_chain_tasks(
+            self.llm, fixed_op_list, self.last_config
+        )
+        for i, (op_name, solver_func, kwargs, output_config) in enumerate(
+            fixed_chain_tasks
+        ):
+            args = [
+                (idx, self.last_config, output_config, solver_func, kwargs)
+                for idx in range(self.num_samples)
+            ]
+            results = self._map(
+                _chain_worker_single_solver, args, chunk_size, desc=op_name
+            )
+            chain_header = [proc_sample for proc_sample, in results]
+            self.last_config = output_config
+
+            history[f"({i}) {output_config['fixed_chain']}"] = chain_header
+            if i == len(fixed_op_list) - 1:
+                final_result = chain_header
+
+        return final_result, history
+
+
+class _LoopBridgedLLM:
+    # Blocking facade over the async client of `llm` for operations running in
+    # worker threads: their requests are sent from the scheduler's event loop,
+    # so all samples share its concurrency limit.
+    def __init__(self, llm, loop):
+        self.llm = llm
+        self.loop = loop
+
+    def __getattr__(self, name):
+        return getattr(self.llm, name)
+
+    def generate_plus_with_score(self, prompt, options=None, end_str=None, **kwargs):
+        future = asyncio.run_coroutine_threadsafe(
+            self.llm.agenerate_plus_with_score(prompt, options, end_str, **kwargs),
+            self.loop,
+        )
+        return future.result()
+
+    def generate(self, prompt, options=None, end_str=None):
+        future = asyncio.run_coroutine_threadsafe(
+            self.llm.agenerate(prompt, options, end_str), self.loop
+        )
+        return future.result()
+
+
+async def _dynamic_chain_exec_one_sample_async(
+    idx,
+    sample,
+    llm,
+    executor,
+    llm_options,
+    strategy,
+    store,
+    plan_once,
+    operation_parameter_dict,
+):
+    loop = asyncio.get_running_loop()
+
+    try:
+        key = ResultStore.make_key(
+            sample,
+            get_dynamic_chain_config(
+                llm, llm_options, strategy, plan_once, operation_parameter_dict
+            ),
+        )
+        # the result store is SQLite, its transactions run in a thread so that
+        # they do not stall the other samples on the event loop
+        cached = await loop.run_in_executor(None, store.get, key)
+        if cached is not None:
+            _, proc_sample, log = cached
+            return idx, proc_sample, log
+
+        checkpoint = store.checkpoint(key)
+        if operation_parameter_dict is None:
+            operation_parameter_dict = get_operation_parameter_dict(llm)
+        dynamic_chain_log = []
+        current_sample = copy.copy(sample)
+        state = await loop.run_in_executor(None, checkpoint.load)
+        if state is not None:
+            current_sample, dynamic_chain_log = state
+        while True:
+            # the sample only holds a worker thread while one of its steps is
+            # running, so steps of all samples are interleaved
+            next_sample, log = await loop.run_in_executor(
+                executor,
+                functools.partial(
+                    dynamic_chain_exec_step,
+                    current_sample,
+                    llm,
+                    llm_options=llm_options,
+                    strategy=strategy,
+                    operation_parameter_dict=operation_parameter_dict,
+                    plan_once=plan_once,
+                ),
+            )
+            dynamic_chain_log.append(log)
+
+            if next_sample is None:
+                break
+            current_sample = next_sample
+            await loop.run_in_executor(
+                None, checkpoint.save, current_sample, dynamic_chain_log
+            )
+
+        await loop.run_in_executor(
+            None, store.put, key, sample, current_sample, dynamic_chain_log
+        )
+        return idx, current_sample, dynamic_chain_log
+    except Exception as e:
+        print(f"Error in {sample['id']}: {e}", flush=True)
+        return idx, None, None
+
+
+async def _fixed_chain_exec_one_sample_async(
+    sample, proc_sample, llm, executor, store, fixed_chain_tasks
+):
+    # runs the fixed chain on a sample as soon as its dynamic chain is done
+    loop = asyncio.get_running_loop()
+
+    try:
+        for op_name, solver_func, kwargs, output_config in fixed_chain_tasks:
+            key = ResultStore.make_key(sample, output_config)
+            cached = await loop.run_in_executor(None, store.get, key)
+            if cached is not None:
+                proc_sample = cached[1]
+                continue
+            if proc_sample is None:
+                return None
+            proc_sample = await loop.run_in_executor(
+                executor,
+                functools.partial(
+                    _conduct_single_solver_step, proc_sample, llm, solver_func, kwargs
+                ),
+            )
+            await loop.run_in_executor(None, store.put, key, sample, proc_sample, None)
+        return proc_sample
+    except Exception as e:
+        print(f"Error in {sample['id']}: {e}", flush=True)
+        return None
+
+
+async def _chain_exec_one_sample_async(
+    idx,
+    sample,
+    llm,
+    executor,
+    llm_options,
+    strategy,
+    store,
+    fixed_chain_tasks,
+    plan_once,
+    operation_parameter_dict,
+):
+    idx, proc_sample, log = await _dynamic_chain_exec_one_sample_async(
+        idx,
+        sample,
+        llm,
+        executor,
+        llm_options,
+        strategy,
+        store,
+        plan_once,
+        operation_parameter_dict,
+    )
+    if not fixed_chain_tasks:
+        return idx, proc_sample, log, proc_sample
+    final_sample = await _fixed_chain_exec_one_sample_async(
+        sample, proc_sample, llm, executor, store, fixed_chain_tasks
+    )
+    return idx, proc_sample, log, final_sample
+
+
+async def _chain_exec_async(
+    all_samples,
+    llm,
+    llm_options,
+    strategy,
+    cache_dir,
+    max_steps_in_flight,
+    fixed_op_list=None,
+    callback=None,
+    plan_once=False,
+    operation_parameter_dict=None,
+):
+    result_samples = [None for _ in range(len(all_samples))]
+    dynamic_chain_log_list = [None for _ in range(len(all_samples))]
+    final_result = [None for _ in range(len(all_samples))]
+
+    store = get_result_store(cache_dir)
+    fit_table_info_cache(all_samples)
+    bridged_llm = _LoopBridgedLLM(llm, asyncio.get_running_loop())
+    fixed_chain_tasks = get_fixed_chain_tasks(
+        llm,
+        fixed_op_list or [],
+        get_dynamic_chain_config(
+            llm, llm_options, strategy, plan_once, operation_parameter_dict
+        ),
+    )
+    with ThreadPoolExecutor(max_workers=max_steps_in_flight) as executor:
+        tasks = [
+            _chain_exec_one_sample_async(
+                idx,
+                sample,
+                bridged_llm,
+                executor,
+                llm_options,
+                strategy,
+                store,
+                fixed_chain_tasks,
+                plan_once,
+                operation_parameter_dict,
+            )
+            for idx, sample in enumerate(all_samples)
+        ]
+        for task in tqdm(asyncio.as_completed(tasks), total=len(tasks)):
+            idx, proc_sample, log, final_sample = await task
+            result_samples[idx] = proc_sample
+            dynamic_chain_log_list[idx] = log
+            final_result[idx] = final_sample
+            if callback is not None:
+                callback(idx, proc_sample, log, final_sample)
+
+    return final_result, result_samples, dynamic_chain_log_list
 
+
+def dynamic_chain_exec_async(
+    all_samples,
+    llm,
+    llm_options=None,
+    strategy="voting",
+    cache_dir="./results/debug",
+    max_steps_in_flight=256,
+    plan_once=False,
+    operation_parameter_dict=None,
+):
+    # Same results and logs as dynamic_chain_exec_with_cache_mp, but every
+    # sample is a resumable chain on one event loop: while a step waits on the
+    # API, steps of other samples run. The number of requests in flight is
+    # bounded by `llm.max_concurrency` (and the rate limiter, if any), not by
+    # the number of processes.
+    os.makedirs(cache_dir, exist_ok=True)
+    _, result_samples, dynamic_chain_log_list = asyncio.run(
+        _chain_exec_async(
+            all_samples,
+            llm,
+            llm_options,
+            strategy,
+            cache_dir,
+            max_steps_in_flight,
+            plan_once=plan_once,
+            operation_parameter_dict=operation_parameter_dict,
+        )
+    )
     return result_samples, dynamic_chain_log_list
+
+
+def fused_chain_exec_async(
+    all_samples,
+    llm,
+    fixed_op_list,
+    llm_options=None,
+    strategy="voting",
+    cache_dir="./results/debug",
+    max_steps_in_flight=256,
+    callback=None,
+    plan_once=False,
+    operation_parameter_dict=None,
+):
+    # dynamic_chain_exec_async followed by fixed_chain_exec_mp, without the
+    # barrier between them: each sample runs `fixed_op_list` (e.g. the final
+    # query) right after its dynamic chain reaches <END>, and
+    # `callback(idx, proc_sample, log, final_sample)` is called as soon as the
+    # sample is done.
+    os.makedirs(cache_dir, exist_ok=True)
+    return asyncio.run(
+        _chain_exec_async(
+            all_samples,
+            llm,
+            llm_options,
+            strategy,
+            cache_dir,
+            max_steps_in_flight,
+            fixed_op_list=fixed_op_list,
+            callback=callback,
+            plan_once=plan_once,
+            operation_parameter_dict=operation_parameter_dict,
+        )
+    )
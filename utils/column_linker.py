@@ -0,0 +1,138 @@
+# Copyright 2024 The Chain-of-Table authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import difflib
+
+from utils.row_index import tokenize
+from utils.table import Table
+
+
+# words that never link a statement to a column on their own
+STOPWORDS = set(
+    "a an and are as at be by did do does for from had has have in is it its of "
+    "on or that the their there they this to was were which who with".split()
+)
+
+
+def _singular(token):
+    if len(token) > 3 and token.endswith("s") and not token.endswith("ss"):
+        return token[:-1]
+    return token
+
+
+def _column_ngrams(table, max_ngram):
+    # n-grams of the cell tokens of every column
+    def _compute():
+        column_ngrams = []
+        for column in table.columns():
+            ngrams = set()
+            for cell in column:
+                tokens = tokenize(cell)
+                for n in range(1, max_ngram + 1):
+                    for start in range(len(tokens) - n + 1):
+                        ngrams.add(" ".join(tokens[start : start + n]))
+            column_ngrams.append(ngrams)
+        return column_ngrams
+
+    return table.memoize(("column_ngrams", max_ngram), _compute)
+
+
+def link_columns(table_text, statement, max_ngram=4, header_ratio=0.85):
+    """Links the statement to the columns of the table, like the
+    "similar words link to columns" and "column value link to columns" steps
+    of the select_column prompt.
+
+    Returns (columns, confidence). The confidence is the share of the content
+    words of the statement explained by a link, divided by the number of
+    columns of the most ambiguous value link. Words that need the semantics
+    of the statement ("total", "most", ...) are left unexplained, so those
+    statements get a low confidence.
+    """
+    table = Table.from_table_text(table_text)
+    tokens = tokenize(statement)
+    singular_tokens = [_singular(t) for t in tokens]
+    content = {i for i, t in enumerate(tokens) if t not in STOPWORDS}
+    if not content:
+        return [], 0.0
+
+    linked = set()
+    covered = set()
+    ambiguity = 1
+
+    # similar words link to columns
+    for j, header in enumerate(table.header):
+        header_tokens = [_singular(t) for t in tokenize(header)]
+        header_str = " ".join(header_tokens)
+        if not header_tokens or set(header_tokens) <= STOPWORDS:
+            continue
+        n = len(header_tokens)
+        for span_len in range(max(1, n - 1), n + 2):
+            for start in range(len(tokens) - span_len + 1):
+                span = range(start, start + span_len)
+                span_str = " ".join(singular_tokens[i] for i in span)
+                ratio = difflib.SequenceMatcher(None, header_str, span_str).ratio()
+                if ratio >= header_ratio:
+                    linked.add(j)
+                    covered.update(span)
+
+    # column value link to columns, longest spans first
+    column_ngrams = _column_ngrams(table, max_ngram)
+    for span_len in range(max_ngram, 0, -1):
+        for start in range(len(tokens) - span_len + 1):
+            span = range(start, start + span_len)
+            if all(i in covered or i not in content for i in span):
+                continue
+            span_str = " ".join(tokens[i] for i in span)
+            columns = [
+                j for j, ngrams in enumerate(column_ngrams) if span_str in ngrams
+            ]
+            if columns:
+                linked.update(columns)
+                covered.update(span)
+                ambiguity = max(ambiguity, len(columns))
+
+    if not linked:
+        return [], 0.0
+    coverage = len(content & covered) / len(content)
+    columns = [table.header[j] for j in sorted(linked)]
+    return columns, coverage / ambiguity
+
+
+def get_column_linker_stats(samples):
+    # LLM calls saved by the linker, and on validated samples (where the LLM
+    # was asked anyway) how often the linker picks the columns of the LLM
+    num_select_column = num_linked = num_validated = num_agreed = 0
+    for sample in samples:
+        # samples whose chain failed are None
+        for operation in (sample or {}).get("chain", []):
+            if operation["operation_name"] != "select_column":
+                continue
+            num_select_column += 1
+            link = operation.get("column_link")
+            if link is None or not link["confident"]:
+                continue
+            if link["used"]:
+                num_linked += 1
+            elif operation["parameter_and_conf"]:
+                num_validated += 1
+                llm_columns = eval(operation["parameter_and_conf"][0][0])
+                llm_columns = sorted(c.lower() for c in llm_columns)
+                num_agreed += llm_columns == sorted(c.lower() for c in link["columns"])
+    return {
+        "select_column": num_select_column,
+        "llm_calls_saved": num_linked,
+        "validated": num_validated,
+        "agreement": num_agreed / num_validated if num_validated else 0.0,
+    }
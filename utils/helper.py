@@ -13,81 +13,82 @@
 # limitations under the License.
 
 
-import pandas as pd
 import json
-import re
-from _ctypes import PyObj_FromPtr
 
+from utils.table import Table
 
-def table2df(table_text, num_rows=100):
-    header, rows = table_text[0], table_text[1:]
-    rows = rows[:num_rows]
-    df = pd.DataFrame(data=rows, columns=header)
-    return df
 
-
-def table2string(
-    table_text,
-    num_rows=100,
-    caption=None,
-):
-    df = table2df(table_text, num_rows)
+def _table2string(table_text, num_rows=100, caption=None, row_ids=None):
     linear_table = ""
     if caption is not None:
         linear_table += "table caption : " + caption + "\n"
 
-    header = "col : " + " | ".join(df.columns) + "\n"
-    linear_table += header
-    rows = df.values.tolist()
-    for row_idx, row in enumerate(rows):
-        row = [str(x) for x in row]
-        line = "row {} : ".format(row_idx + 1) + " | ".join(row)
-        if row_idx != len(rows) - 1:
-            line += "\n"
-        linear_table += line
+    linear_table += "col : " + " | ".join(table_text[0]) + "\n"
+    lines = []
+    for row_idx, row in enumerate(table_text[1:][:num_rows]):
+        if row_ids is not None:
+            # the rows are a subset of a larger table, keep their ids in it
+            row_idx = row_ids[row_idx]
+        lines.append(
+            "row {} : ".format(row_idx + 1) + " | ".join([str(x) for x in row])
+        )
+    linear_table += "\n".join(lines)
     return linear_table
 
 
-class NoIndent(object):
-    """Value wrapper."""
-
-    def __init__(self, value):
-        self.value = value
-
-
-class MyEncoder(json.JSONEncoder):
-    FORMAT_SPEC = "@@{}@@"
-    regex = re.compile(FORMAT_SPEC.format(r"(\d+)"))
-
-    def __init__(self, **kwargs):
-        # Save copy of any keyword argument values needed for use here.
-        self.__sort_keys = kwargs.get("sort_keys", None)
-        super(MyEncoder, self).__init__(**kwargs)
-
-    def default(self, obj):
-        return (
-            self.FORMAT_SPEC.format(id(obj))
-            if isinstance(obj, NoIndent)
-            else super(MyEncoder, self).default(obj)
+def table2string(
+    table_text,
+    num_rows=100,
+    caption=None,
+    row_ids=None,
+):
+    if isinstance(table_text, Table):
+        # tables are immutable, so the string can be reused by every prompt
+        key_row_ids = None if row_ids is None else tuple(row_ids)
+        return table_text.memoize(
+            ("table2string", num_rows, caption, key_row_ids),
+            lambda: _table2string(table_text, num_rows, caption, row_ids),
         )
+    return _table2string(table_text, num_rows, caption, row_ids)
 
-    def encode(self, obj):
-        format_spec = self.FORMAT_SPEC  # Local var to expedite access.
-        json_repr = super(MyEncoder, self).encode(obj)  # Default JSON.
 
-        # Replace any marked-up object ids in the JSON repr with the
-        # value returned from the json.dumps() of the corresponding
-        # wrapped Python object.
-        for match in self.regex.finditer(json_repr):
-            # see https://stackoverflow.com/a/15012814/355230
-            id = int(match.group(1))
-            no_indent = PyObj_FromPtr(id)
-            json_obj_repr = json.dumps(no_indent.value, sort_keys=self.__sort_keys)
+def _table2column_priority_json(table_text, num_rows=100, caption=None):
+    if isinstance(table_text, Table):
+        header = table_text.header
+        columns = [table_text.column(j)[:num_rows] for j in range(len(header))]
+    else:
+        header = table_text[0]
+        rows = table_text[1:][:num_rows]
+        columns = [[row[j] for row in rows] for j in range(len(header))]
 
-            # Replace the matched id string with json formatted representation
-            # of the corresponding Python object.
-            json_repr = json_repr.replace(
-                '"{}"'.format(format_spec.format(id)), json_obj_repr
+    lines = ["{"]
+    if caption is not None:
+        lines.append(
+            '  "table_caption": ' + json.dumps(caption, ensure_ascii=False) + ","
+        )
+    lines.append('  "columns": ' + json.dumps(list(header)) + ",")
+    if header:
+        lines.append('  "table_column_priority": [')
+        lines.append(
+            ",\n".join(
+                "    " + json.dumps([h] + list(column))
+                for h, column in zip(header, columns)
             )
-
-        return json_repr
+        )
+        lines.append("  ]")
+    else:
+        lines.append('  "table_column_priority": []')
+    lines.append("}")
+    return "\n".join(lines)
+
+
+def table2column_priority_json(table_text, num_rows=100, caption=None):
+    # The column-major table of the select_column prompt, with one line per
+    # column (see benchmarks/select_column_prompt.py for the json.dumps()
+    # implementation it replaces).
+    if isinstance(table_text, Table):
+        return table_text.memoize(
+            ("table2column_priority_json", num_rows, caption),
+            lambda: _table2column_priority_json(table_text, num_rows, caption),
+        )
+    return _table2column_priority_json(table_text, num_rows, caption)
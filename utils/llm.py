@@ -13,15 +13,70 @@
 # limitations under the License.
 
 
+import asyncio
 import openai
+from collections import defaultdict
+import random
 import time
 import numpy as np
 
+from utils.cache import LLMCache
+from utils.rate_limit import parse_duration
+from utils.token_budget import (
+    count_message_tokens,
+    get_context_window,
+    has_tokenizer,
+)
+
 
 class ChatGPT:
-    def __init__(self, model_name, key):
+    # errors that will not go away by retrying the same request
+    permanent_errors = (
+        openai.error.InvalidRequestError,
+        openai.error.AuthenticationError,
+        openai.error.PermissionError,
+        openai.error.InvalidAPIType,
+        openai.error.SignatureVerificationError,
+    )
+
+    def __init__(
+        self,
+        model_name,
+        key,
+        max_concurrency=64,
+        cache=None,
+        rate_limiter=None,
+        retry_limit=6,
+        max_backoff=60,
+    ):
         self.model_name = model_name
         self.key = key
+        # optional LLMCache shared by every process of a run
+        self.cache = cache
+        # optional RateLimiter shared by every process of a run
+        self.rate_limiter = rate_limiter
+        self.retry_limit = retry_limit
+        self.max_backoff = max_backoff
+        # prompt + completion tokens the model accepts, None if unknown
+        self.context_window = get_context_window(model_name)
+        # max number of in-flight requests of the async client (per event loop)
+        self.max_concurrency = max_concurrency
+        self._semaphore = None
+        self._semaphore_loop = None
+
+    def __getstate__(self):
+        # asyncio primitives are bound to an event loop and cannot be pickled
+        state = self.__dict__.copy()
+        state["_semaphore"] = None
+        state["_semaphore_loop"] = None
+        return state
+
+    def _get_semaphore(self):
+        loop = asyncio.get_running_loop()
+        if self._semaphore is None or self._semaphore_loop is not loop:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._semaphore_loop = loop
+        return self._semaphore
 
     def get_model_options(
         self,
@@ -37,21 +92,103 @@ class ChatGPT:
             max_tokens=per_example_max_decode_steps,
         )
 
-    def generate_plus_with_score(self, prompt, options=None, end_str=None):
-        if options is None:
-            options = self.get_model_options()
-        messages = [
+    def _build_messages(self, prompt):
+        return [
             {
                 "role": "system",
                 "content": "I will give you some examples, you need to follow the examples and complete the text, and no other content.",
             },
             {"role": "user", "content": prompt},
         ]
+
+    def count_prompt_tokens(self, prompt):
+        return count_message_tokens(self._build_messages(prompt), self.model_name)
+
+    def get_prompt_budget(self, options=None):
+        # max number of prompt tokens that leaves room for the completion,
+        # None when prompts cannot be counted exactly: an estimate would drop
+        # rows of tables that fit and reject prompts the API accepts
+        if self.context_window is None or not has_tokenizer(self.model_name):
+            return None
+        if options is None:
+            options = self.get_model_options()
+        return self.context_window - options.get("max_tokens", 0)
+
+    def _check_prompt_size(self, prompt, options):
+        # the API would reject the request anyway, do not pay a round trip for it
+        budget = self.get_prompt_budget(options)
+        if budget is None:
+            return
+        num_tokens = self.count_prompt_tokens(prompt)
+        if num_tokens > budget:
+            raise Exception(
+                f"This model's maximum context length is {self.context_window} "
+                f"tokens. However, the messages have {num_tokens} tokens and "
+                f"{options.get('max_tokens', 0)} tokens are kept for the completion."
+            )
+
+    def _estimate_tokens(self, prompt, options):
+        # rough count in the way the provider charges a request: the prompt
+        # plus the maximum number of tokens that can be generated
+        return len(prompt) // 4 + options.get("max_tokens", 0) * options.get("n", 1)
+
+    def _rate_limit_wait(self, prompt, options):
+        if self.rate_limiter is None:
+            return 0
+        return self.rate_limiter.reserve(self._estimate_tokens(prompt, options))
+
+    def _handle_request_error(self, e, retry_num):
+        # return (gpt_responses, error, seconds to wait before the next retry)
+        print(str(e), flush=True)
+        placeholder = {"choices": [{"message": {"content": "PLACEHOLDER"}}]}
+        if "This model's maximum context length is" in str(e):
+            return placeholder, str(e), 0
+        elif isinstance(e, self.permanent_errors):
+            return placeholder, str(e), 0
+        elif retry_num >= self.retry_limit:
+            return placeholder, "too many retry times", 0
+
+        # exponential backoff with full jitter, so that workers hitting the
+        # same error do not retry in lockstep
+        wait = random.uniform(0, min(self.max_backoff, 2**retry_num))
+        headers = getattr(e, "headers", None) or {}
+        if isinstance(e, openai.error.RateLimitError) and self.rate_limiter is not None:
+            # the limiter holds back the next reservation of every worker
+            self.rate_limiter.penalize(headers=headers)
+        elif "retry-after" in headers:
+            wait += parse_duration(headers["retry-after"]) or 0
+        return None, str(e), wait
+
+    def _parse_responses(self, gpt_responses):
+        results = []
+        for i, res in enumerate(gpt_responses["choices"]):
+            text = res["message"]["content"]
+            fake_conf = (len(gpt_responses["choices"]) - i) / len(
+                gpt_responses["choices"]
+            )
+            results.append((text, np.log(fake_conf)))
+
+        return results
+
+    def generate_plus_with_score(
+        self, prompt, options=None, end_str=None, cache_tag=None
+    ):
+        if options is None:
+            options = self.get_model_options()
+        messages = self._build_messages(prompt)
+        if self.cache is not None:
+            cache_key = LLMCache.make_key(
+                self.model_name, messages, options, end_str, tag=cache_tag
+            )
+            cached_results = self.cache.get(cache_key)
+            if cached_results is not None:
+                return cached_results
+        self._check_prompt_size(prompt, options)
         gpt_responses = None
         retry_num = 0
-        retry_limit = 2
         error = None
         while gpt_responses is None:
+            time.sleep(self._rate_limit_wait(prompt, options))
             try:
                 gpt_responses = openai.ChatCompletion.create(
                     model=self.model_name,
@@ -62,31 +199,14 @@ class ChatGPT:
                 )
                 error = None
             except Exception as e:
-                print(str(e), flush=True)
-                error = str(e)
-                if "This model's maximum context length is" in str(e):
-                    print(e, flush=True)
-                    gpt_responses = {
-                        "choices": [{"message": {"content": "PLACEHOLDER"}}]
-                    }
-                elif retry_num > retry_limit:
-                    error = "too many retry times"
-                    gpt_responses = {
-                        "choices": [{"message": {"content": "PLACEHOLDER"}}]
-                    }
-                else:
-                    time.sleep(60)
-                retry_num += 1
+                gpt_responses, error, wait = self._handle_request_error(e, retry_num)
+                time.sleep(wait)
+            retry_num += 1
         if error:
             raise Exception(error)
-        results = []
-        for i, res in enumerate(gpt_responses["choices"]):
-            text = res["message"]["content"]
-            fake_conf = (len(gpt_responses["choices"]) - i) / len(
-                gpt_responses["choices"]
-            )
-            results.append((text, np.log(fake_conf)))
-
+        results = self._parse_responses(gpt_responses)
+        if self.cache is not None:
+            self.cache.set(cache_key, results)
         return results
 
     def generate(self, prompt, options=None, end_str=None):
@@ -95,3 +215,109 @@ class ChatGPT:
         options["n"] = 1
         result = self.generate_plus_with_score(prompt, options, end_str)[0][0]
         return result
+
+    async def _run_blocking(self, func, *args):
+        # cache and rate limiter transactions (which may wait for the SQLite
+        # lock) and token counting run in a thread, so that they do not stall
+        # the requests of the other samples on the event loop
+        return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+    async def agenerate_plus_with_score(
+        self, prompt, options=None, end_str=None, cache_tag=None
+    ):
+        if options is None:
+            options = self.get_model_options()
+        messages = self._build_messages(prompt)
+        if self.cache is not None:
+            cache_key = LLMCache.make_key(
+                self.model_name, messages, options, end_str, tag=cache_tag
+            )
+            cached_results = await self._run_blocking(self.cache.get, cache_key)
+            if cached_results is not None:
+                return cached_results
+        await self._run_blocking(self._check_prompt_size, prompt, options)
+        gpt_responses = None
+        retry_num = 0
+        error = None
+        while gpt_responses is None:
+            await asyncio.sleep(
+                await self._run_blocking(self._rate_limit_wait, prompt, options)
+            )
+            try:
+                # only hold a slot while the request is in flight, not while backing off
+                async with self._get_semaphore():
+                    gpt_responses = await openai.ChatCompletion.acreate(
+                        model=self.model_name,
+                        messages=messages,
+                        stop=end_str,
+                        api_key=self.key,
+                        **options
+                    )
+                error = None
+            except Exception as e:
+                gpt_responses, error, wait = await self._run_blocking(
+                    self._handle_request_error, e, retry_num
+                )
+                await asyncio.sleep(wait)
+            retry_num += 1
+        if error:
+            raise Exception(error)
+        results = self._parse_responses(gpt_responses)
+        if self.cache is not None:
+            await self._run_blocking(self.cache.set, cache_key, results)
+        return results
+
+    async def agenerate(self, prompt, options=None, end_str=None):
+        if options is None:
+            options = self.get_model_options()
+        options["n"] = 1
+        result = (await self.agenerate_plus_with_score(prompt, options, end_str))[0][0]
+        return result
+
+
+def generate_until_consensus(llm, prompt, options, get_vote, top_k=2, end_str=None):
+    """Draws the `options["n"]` samples of `prompt` sequentially and stops as
+    soon as the `top_k` answers of the vote cannot change anymore.
+
+    Samples get the same fake confidence as in a single request of n samples
+    (the j-th of n has log((n - j) / n)), and `get_vote(text)` maps a sample to
+    the answer it votes for (None for no vote). The vote stops when even all
+    the confidence left to draw would not lift another answer above the
+    `top_k`-th one, so the `top_k` answers are those of the full n samples.
+    """
+    n = options.get("n", 1)
+    confs = [(n - j) / n for j in range(n)]
+
+    # nothing can be decided before the confidence left is below the
+    # `top_k`-th largest one
+    num_samples = n
+    for m in range(1, n + 1):
+        if sum(confs[m:]) < confs[min(top_k, n) - 1]:
+            num_samples = m
+            break
+
+    responses = []
+    tally = defaultdict(float)
+    while True:
+        batch_options = dict(options, n=num_samples - len(responses))
+        kwargs = {}
+        if responses:
+            # a follow-up draw is the same request as the previous one, it
+            # must not be answered by the response cached for it
+            kwargs["cache_tag"] = f"draw-{len(responses)}"
+        for text, _ in llm.generate_plus_with_score(
+            prompt, options=batch_options, end_str=end_str, **kwargs
+        ):
+            conf = confs[len(responses)]
+            responses.append((text, np.log(conf)))
+            vote = get_vote(text)
+            if vote is not None:
+                tally[vote] += conf
+        if len(responses) >= n:
+            break
+
+        ranked = sorted(tally.values(), reverse=True) + [0.0] * (top_k + 1)
+        if ranked[top_k - 1] > ranked[top_k] + sum(confs[len(responses) :]):
+            break
+        num_samples = len(responses) + 1
+    return responses
@@ -16,6 +16,8 @@
 import json
 from tqdm import tqdm
 
+from utils.table import table_fingerprint
+
 def load_tabfact_dataset(
     dataset_path,
     raw2clean_path,
@@ -30,6 +32,7 @@ def load_tabfact_dataset(
             tabfact_statement_raw2clean_dict[info["statement"]] = info["cleaned_statement"]
 
     dataset = []
+    tables = {}
     if first_n != -1:
         all_lines = []
         for line in open(dataset_path):
@@ -41,6 +44,12 @@ def load_tabfact_dataset(
         info = json.loads(line)
         info["id"] = f"{tag}-{i}"
         info["chain"] = []
+        # statements over the same table share one table_text object, and
+        # table-level artifacts are cached under the fingerprint
+        info["table_fingerprint"] = table_fingerprint(info["table_text"])
+        info["table_text"] = tables.setdefault(
+            info["table_fingerprint"], info["table_text"]
+        )
         if info["statement"] in tabfact_statement_raw2clean_dict:
             info["cleaned_statement"] = tabfact_statement_raw2clean_dict[
                 info["statement"]
@@ -0,0 +1,106 @@
+# Copyright 2024 The Chain-of-Table authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import re
+
+
+# value classes, from the most to the least specific
+VALUE_CLASSES = [
+    r"\d+",
+    r"-?\d+(?:\.\d+)?",
+    r"[^\W\d_]+",
+    r"\w+",
+    r"[^\W_]+(?: [^\W_]+)*",
+    r".+?",
+]
+
+NORMALIZATIONS = {
+    "identity": lambda s: s,
+    "remove_commas": lambda s: s.replace(",", ""),
+}
+
+
+def _candidate_patterns(source, target):
+    # all regexes with one group that extract `target` from `source`,
+    # with the anchored (i.e. stricter) ones first
+    value_classes = [c for c in VALUE_CLASSES if re.fullmatch(c, target)]
+    candidates = []
+    start = source.find(target)
+    while start != -1 and target:
+        left = source[:start]
+        right = source[start + len(target) :]
+        left_contexts = ["^" if left == "" else re.escape(left[-1]), ""]
+        right_contexts = ["$" if right == "" else re.escape(right[0]), ""]
+        for value_class in value_classes:
+            for left_context in left_contexts:
+                for right_context in right_contexts:
+                    if value_class == r".+?" and not right_context:
+                        continue
+                    candidates.append(
+                        left_context + "(" + value_class + ")" + right_context
+                    )
+        start = source.find(target, start + 1)
+    return candidates
+
+
+def parse_source_column(explanation):
+    # the column named in `We extract the value from column "X"`, or None
+    match = re.search(r'We extract the value from column "([^"]*)"', explanation)
+    return None if match is None else match.group(1)
+
+
+def induce_extraction_program(headers, rows, values, source_column=None):
+    """Learns how `values` were extracted from one column of `rows`.
+
+    If `source_column` (the header the LLM says it extracts from) is given,
+    only that column is tried: the examples may also match another column by
+    chance, e.g. a running index. Returns a program (column index,
+    normalization, regex) that reproduces every example value, or None if no
+    such program is found.
+    """
+    if not rows or len(rows) != len(values):
+        return None
+    column_indices = range(len(headers))
+    if source_column is not None:
+        column_indices = [
+            j
+            for j, header in enumerate(headers)
+            if header.strip().lower() == source_column.strip().lower()
+        ]
+    for column_index in column_indices:
+        for normalization, normalize in NORMALIZATIONS.items():
+            try:
+                sources = [normalize(row[column_index]) for row in rows]
+            except IndexError:
+                break
+            for pattern in _candidate_patterns(sources[0], values[0]):
+                program = (column_index, normalization, pattern)
+                if all(
+                    apply_extraction_program(program, row) == value
+                    for row, value in zip(rows, values)
+                ):
+                    return program
+    return None
+
+
+def apply_extraction_program(program, row):
+    column_index, normalization, pattern = program
+    if column_index >= len(row):
+        return None
+    source = NORMALIZATIONS[normalization](row[column_index])
+    match = re.search(pattern, source)
+    if match is None or not match.group(1):
+        return None
+    return match.group(1)
@@ -0,0 +1,185 @@
+# Copyright 2024 The Chain-of-Table authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import re
+from collections import Counter
+
+import numpy as np
+
+
+_NOT_NUM_OR_DOT = re.compile(r"[^0-9.]+")
+# characters dropped by only_keep_num_and_first_dot, but for the "\x00" that
+# separates the cells of a column
+_NOT_NUM_DOT_OR_SEP = re.compile(r"[^0-9.\x00]+")
+
+# a month, a year or a numeric date, in a lowercase cell
+_DATE = re.compile(
+    r"\b(?:jan(?:uary)?|feb(?:ruary)?|mar(?:ch)?|apr(?:il)?|may|june?|july?"
+    r"|aug(?:ust)?|sep(?:t(?:ember)?)?|oct(?:ober)?|nov(?:ember)?|dec(?:ember)?)\b"
+    r"|\b(?:1[5-9]|20)\d\d\b"
+    r"|\b\d{1,2}[/.-]\d{1,2}[/.-]\d{2,4}\b"
+)
+
+
+def _keep_first_dot(ns, s):
+    head, dot, tail = ns.partition(".")
+    ns = head + dot + tail.replace(".", "")
+    if ns == "" or ns == ".":
+        return ""
+    if s.lstrip().startswith("-"):
+        ns = "-" + ns
+    return ns
+
+
+def only_keep_num_and_first_dot(s):
+    # the digits of `s` and its first dot, with a minus if `s` starts with one
+    return _keep_first_dot(_NOT_NUM_OR_DOT.sub("", s), s)
+
+
+def _only_keep_num_and_first_dot_column(values):
+    # only_keep_num_and_first_dot of every cell, with one regex pass over the
+    # whole column
+    joined = "\x00".join(values)
+    digits = _NOT_NUM_DOT_OR_SEP.sub("", joined).split("\x00")
+    if len(digits) != len(values):
+        # a cell has its own "\x00"
+        return [only_keep_num_and_first_dot(v) for v in values]
+    # most cells have neither a dot nor a minus, and keep their digits as is
+    return [
+        _keep_first_dot(ns, s) if "." in ns or "-" in s else ns
+        for ns, s in zip(digits, values)
+    ]
+
+
+def _parse_number(v_str):
+    try:
+        return float(v_str)
+    except ValueError:
+        return None
+
+
+def column_profile(table, index):
+    # Type profile of one column of a Table. It is memoized on the table, so
+    # it is computed once for all statements (and operations) on the table,
+    # and the profiles of the dataset tables can be kept across runs (see
+    # `load_column_profiles`).
+    def _compute():
+        values = table.column(index)
+        numbers = _only_keep_num_and_first_dot_column(values)
+        parsed = [_parse_number(v) if v else None for v in numbers]
+        number_mask = np.array([v is not None for v in parsed], dtype=bool)
+        numeric = np.array([np.nan if v is None else v for v in parsed], dtype=float)
+        null_mask = np.array([not v.strip() for v in values], dtype=bool)
+        keys = numeric[number_mask]
+        value_counts = Counter(values)
+        return {
+            "values": values,
+            # the number sort_column reads from each cell, "" if none
+            "numbers": numbers,
+            "numeric": numeric,
+            "number_mask": number_mask,
+            "null_mask": null_mask,
+            "num_non_empty": int(len(values) - null_mask.sum()),
+            "value_counts": value_counts,
+            "num_distinct": sum(1 for v in value_counts if v.strip()),
+            # numeric values in table order, as sort_column compares them
+            "numeric_sorted": bool(
+                np.all(keys[1:] >= keys[:-1]) or np.all(keys[1:] <= keys[:-1])
+            ),
+            "num_dates": sum(
+                count
+                for v, count in value_counts.items()
+                if _DATE.search(v.lower())
+            ),
+        }
+
+    return table.memoize(("column_profile", index), _compute)
+
+
+def check_if_group(profile):
+    # group_column only keeps columns with repeated values
+    if profile["num_non_empty"] == 0:
+        return False
+    return profile["num_distinct"] / profile["num_non_empty"] <= 0.8
+
+
+def check_if_sort(profile):
+    # sort_column only applies numerical sorts of columns not already sorted
+    return not profile["numeric_sorted"]
+
+
+def get_infeasible_operations(table):
+    # Operations whose result would be discarded whatever the LLM answers, so
+    # that they are neither planned nor solved.
+    def _compute():
+        profiles = [column_profile(table, j) for j in range(table.num_columns)]
+        infeasible = []
+        if table.num_rows <= 1:
+            infeasible.append("select_row")
+        if table.num_columns <= 1:
+            infeasible.append("select_column")
+        if not any(check_if_group(profile) for profile in profiles):
+            infeasible.append("group_column")
+        if not any(check_if_sort(profile) for profile in profiles):
+            infeasible.append("sort_column")
+        return infeasible
+
+    return table.memoize("infeasible_operations", _compute)
+
+
+# Optional ProfileStore (see utils/profile_store.py) where the column profiles
+# of the dataset tables are kept, so that later runs do not profile them again.
+_profile_store = None
+
+# bump when the fields of column_profile or how they are computed change, so
+# that profiles stored by older code are computed again
+PROFILE_VERSION = 1
+
+# fields rebuilt from the cells on load: the cells are already in the dataset
+_UNSTORED_FIELDS = ("values", "value_counts")
+
+
+def set_profile_store(store):
+    global _profile_store
+    _profile_store = store
+
+
+def get_profile_store():
+    return _profile_store
+
+
+def load_column_profiles(table, fingerprint):
+    # Fills the column profiles of an original table from the profile store,
+    # or profiles the table and stores them.
+    if _profile_store is None:
+        return
+    profiles = _profile_store.get(fingerprint, PROFILE_VERSION)
+    if profiles is None or len(profiles) != table.num_columns:
+        profiles = [column_profile(table, j) for j in range(table.num_columns)]
+        _profile_store.put(
+            fingerprint,
+            PROFILE_VERSION,
+            [
+                {k: v for k, v in p.items() if k not in _UNSTORED_FIELDS}
+                for p in profiles
+            ],
+        )
+        return
+    for j, profile in enumerate(profiles):
+        values = table.column(j)
+        table.memoize(
+            ("column_profile", j),
+            lambda: dict(profile, values=values, value_counts=Counter(values)),
+        )
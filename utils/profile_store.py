@@ -0,0 +1,67 @@
+# Copyright 2024 The Chain-of-Table authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import pickle
+
+from utils.storage import SQLiteStore
+
+
+class ProfileStore(SQLiteStore):
+    """Column profiles of tables (see `column_profile`), keyed by the table
+    fingerprint, in one SQLite file shared by runs over the same dataset.
+    Profiles stored with another `version` are computed again."""
+
+    schema = [
+        "CREATE TABLE IF NOT EXISTS column_profiles ("
+        "fingerprint TEXT PRIMARY KEY, version INTEGER NOT NULL, "
+        "value BLOB NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS column_profile_stats ("
+        "name TEXT PRIMARY KEY, count INTEGER NOT NULL)",
+    ]
+
+    def _count(self, conn, name):
+        conn.execute(
+            "INSERT INTO column_profile_stats (name, count) VALUES (?, 1) "
+            "ON CONFLICT(name) DO UPDATE SET count = count + 1",
+            (name,),
+        )
+
+    def get(self, fingerprint, version):
+        # once per table and process, so the hit/miss counts are written right
+        # away, and are those of every process (e.g. the workers of a pool)
+        conn = self._get_conn()
+        row = conn.execute(
+            "SELECT value FROM column_profiles WHERE fingerprint = ? AND version = ?",
+            (fingerprint, version),
+        ).fetchone()
+        self._count(conn, "misses" if row is None else "hits")
+        return None if row is None else pickle.loads(row[0])
+
+    def put(self, fingerprint, version, profiles):
+        self._get_conn().execute(
+            "INSERT OR REPLACE INTO column_profiles (fingerprint, version, value) "
+            "VALUES (?, ?, ?)",
+            (fingerprint, version, pickle.dumps(profiles)),
+        )
+
+    def stats(self):
+        conn = self._get_conn()
+        counts = dict(conn.execute("SELECT name, count FROM column_profile_stats"))
+        (num_entries,) = conn.execute("SELECT COUNT(*) FROM column_profiles").fetchone()
+        return {
+            "hits": counts.get("hits", 0),
+            "misses": counts.get("misses", 0),
+            "entries": num_entries,
+        }
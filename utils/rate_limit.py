@@ -0,0 +1,137 @@
+# Copyright 2024 The Chain-of-Table authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import re
+import time
+
+from utils.storage import SQLiteStore
+
+
+def parse_duration(value):
+    # "1s", "6m0s", "120ms", "0.5" -> seconds
+    if value is None:
+        return None
+    value = str(value).strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    units = {"h": 3600, "m": 60, "s": 1, "ms": 0.001}
+    parts = re.findall(r"([\d.]+)(ms|h|m|s)", value)
+    if not parts:
+        return None
+    return sum(float(num) * units[unit] for num, unit in parts)
+
+
+class RateLimiter(SQLiteStore):
+    """Client-side requests/minute and tokens/minute limiter.
+
+    Both limits are token buckets kept in a SQLite file, so every worker
+    process of a run draws from the same budget. A reservation may drive a
+    bucket into debt; the caller then waits until its share is refilled, which
+    spaces requests out instead of letting all workers retry at once.
+    """
+
+    schema = [
+        "CREATE TABLE IF NOT EXISTS rate_limit ("
+        "name TEXT PRIMARY KEY, level REAL NOT NULL, updated REAL NOT NULL)",
+    ]
+
+    def __init__(self, path, requests_per_minute=3500, tokens_per_minute=180000):
+        super().__init__(path)
+        self.capacity = {
+            "requests": requests_per_minute,
+            "tokens": tokens_per_minute,
+        }
+
+    def _load(self, conn, now):
+        levels = {}
+        for name, level, updated in conn.execute(
+            "SELECT name, level, updated FROM rate_limit"
+        ):
+            levels[name] = (level, updated)
+
+        state = {}
+        for name, capacity in self.capacity.items():
+            level, updated = levels.get(name, (capacity, now))
+            level = min(capacity, level + (now - updated) * capacity / 60)
+            state[name] = level
+        blocked_until, _ = levels.get("blocked_until", (0, now))
+        return state, blocked_until
+
+    def _store(self, conn, state, blocked_until, now):
+        rows = [(name, level, now) for name, level in state.items()]
+        rows.append(("blocked_until", blocked_until, now))
+        conn.executemany(
+            "INSERT OR REPLACE INTO rate_limit (name, level, updated) VALUES (?, ?, ?)",
+            rows,
+        )
+
+    def reserve(self, num_tokens):
+        # Take one request and `num_tokens` tokens from the buckets and return
+        # the number of seconds to wait before sending the request.
+        conn = self._get_conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            now = time.time()
+            state, blocked_until = self._load(conn, now)
+            state["requests"] -= 1
+            state["tokens"] -= num_tokens
+            wait = max(0, blocked_until - now)
+            for name, capacity in self.capacity.items():
+                if state[name] < 0:
+                    wait = max(wait, -state[name] * 60 / capacity)
+            self._store(conn, state, blocked_until, now)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return wait
+
+    def penalize(self, retry_after=None, headers=None):
+        # Called on a 429: pause all workers for `retry_after` seconds and
+        # clamp the buckets to what the provider reports as remaining.
+        headers = headers or {}
+        if retry_after is None:
+            retry_after = parse_duration(headers.get("retry-after"))
+        if retry_after is None:
+            resets = [
+                parse_duration(headers.get("x-ratelimit-reset-requests")),
+                parse_duration(headers.get("x-ratelimit-reset-tokens")),
+            ]
+            resets = [x for x in resets if x is not None]
+            retry_after = max(resets) if resets else None
+        remaining = {
+            "requests": headers.get("x-ratelimit-remaining-requests"),
+            "tokens": headers.get("x-ratelimit-remaining-tokens"),
+        }
+
+        conn = self._get_conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            now = time.time()
+            state, blocked_until = self._load(conn, now)
+            for name in state:
+                if remaining[name] is not None:
+                    state[name] = min(state[name], float(remaining[name]))
+                else:
+                    state[name] = min(state[name], 0)
+            if retry_after is not None:
+                blocked_until = max(blocked_until, now + retry_after)
+            self._store(conn, state, blocked_until, now)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
@@ -0,0 +1,148 @@
+# Copyright 2024 The Chain-of-Table authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import hashlib
+import json
+import pickle
+
+from utils.storage import SQLiteStore
+from utils.table import table_fingerprint
+
+
+class ResultStore(SQLiteStore):
+    """Results of the dynamic chains of a run, in one SQLite file.
+
+    Entries are keyed by a hash of the sample content and the run config
+    (see `make_key`), so a result is never returned for another sample when
+    `first_n` or the order of the dataset changes. The store also keeps the
+    step checkpoints of unfinished chains. Every write is a transaction, so
+    a crash cannot leave a torn entry behind.
+    """
+
+    schema = [
+        "CREATE TABLE IF NOT EXISTS results ("
+        "key TEXT PRIMARY KEY, sample_id TEXT, value BLOB NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS checkpoints ("
+        "key TEXT PRIMARY KEY, value BLOB NOT NULL)",
+    ]
+
+    @staticmethod
+    def make_key(sample, config):
+        content = {k: v for k, v in sample.items() if k != "table_text"}
+        content["table_text"] = sample.get("table_fingerprint") or table_fingerprint(
+            sample["table_text"]
+        )
+        key = json.dumps(
+            [content, config], sort_keys=True, ensure_ascii=False, default=str
+        )
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def _write(self, statements):
+        conn = self._get_conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for statement, params in statements:
+                conn.execute(statement, params)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def get(self, key):
+        # returns (sample, processed sample, dynamic chain log) or None
+        row = (
+            self._get_conn()
+            .execute("SELECT value FROM results WHERE key = ?", (key,))
+            .fetchone()
+        )
+        if row is None:
+            return None
+        return pickle.loads(row[0])
+
+    def put(self, key, sample, proc_sample, log):
+        # the checkpoint of the chain is dropped in the same transaction
+        value = pickle.dumps((sample, proc_sample, log))
+        self._write(
+            [
+                (
+                    "INSERT OR REPLACE INTO results (key, sample_id, value) "
+                    "VALUES (?, ?, ?)",
+                    (key, str(sample.get("id")), value),
+                ),
+                ("DELETE FROM checkpoints WHERE key = ?", (key,)),
+            ]
+        )
+
+    def __contains__(self, key):
+        row = (
+            self._get_conn()
+            .execute("SELECT 1 FROM results WHERE key = ?", (key,))
+            .fetchone()
+        )
+        return row is not None
+
+    def __len__(self):
+        return self._get_conn().execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+    def items(self):
+        for key, value in self._get_conn().execute(
+            "SELECT key, value FROM results ORDER BY rowid"
+        ):
+            yield key, pickle.loads(value)
+
+    def export(self, path):
+        # bulk export of all results to one pickle: {key: (sample, proc_sample, log)}
+        with open(path, "wb") as f:
+            pickle.dump(dict(self.items()), f)
+
+    def checkpoint(self, key):
+        return StepCheckpoint(self, key)
+
+
+class StepCheckpoint:
+    """Progress of the dynamic chain of one sample.
+
+    Saved after every completed operation, so that a restarted run resumes the
+    chain from its last completed step instead of from scratch.
+    """
+
+    def __init__(self, store, key):
+        self.store = store
+        self.key = key
+
+    def load(self):
+        # returns (current sample, dynamic chain log) or None
+        row = (
+            self.store._get_conn()
+            .execute("SELECT value FROM checkpoints WHERE key = ?", (self.key,))
+            .fetchone()
+        )
+        if row is None:
+            return None
+        return pickle.loads(row[0])
+
+    def save(self, current_sample, dynamic_chain_log):
+        value = pickle.dumps((current_sample, dynamic_chain_log))
+        self.store._write(
+            [
+                (
+                    "INSERT OR REPLACE INTO checkpoints (key, value) VALUES (?, ?)",
+                    (self.key, value),
+                )
+            ]
+        )
+
+    def clear(self):
+        self.store._write([("DELETE FROM checkpoints WHERE key = ?", (self.key,))])
@@ -0,0 +1,85 @@
+# Copyright 2024 The Chain-of-Table authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import math
+import re
+from collections import Counter, defaultdict
+
+from utils.table import Table
+
+
+def _normalize_number(token):
+    # "48,308" -> "48308", "7.0" -> "7", "07" -> "7"
+    try:
+        value = float(token.replace(",", ""))
+    except ValueError:
+        return token
+    if value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def tokenize(text):
+    tokens = re.findall(r"\d+(?:[.,]\d+)*|[^\W\d_]+", str(text).lower())
+    return [_normalize_number(t) if t[0].isdigit() else t for t in tokens]
+
+
+class RowIndex:
+    """BM25 index of the rows of a table, a row being the bag of the tokens
+    of its cells."""
+
+    def __init__(self, table, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        # token -> [(row, term frequency)]
+        self.postings = defaultdict(list)
+        self.row_lengths = []
+        for i, row in enumerate(table.rows()):
+            counts = Counter(tokenize(" ".join(row)))
+            self.row_lengths.append(sum(counts.values()))
+            for token, tf in counts.items():
+                self.postings[token].append((i, tf))
+        self.num_rows = len(self.row_lengths)
+        self.avg_row_length = sum(self.row_lengths) / max(self.num_rows, 1)
+
+    def score(self, text):
+        scores = [0.0] * self.num_rows
+        for token in set(tokenize(text)):
+            postings = self.postings.get(token)
+            if not postings:
+                continue
+            idf = math.log(
+                1 + (self.num_rows - len(postings) + 0.5) / (len(postings) + 0.5)
+            )
+            for i, tf in postings:
+                norm = self.k1 * (
+                    1 - self.b + self.b * self.row_lengths[i] / self.avg_row_length
+                )
+                scores[i] += idf * tf * (self.k1 + 1) / (tf + norm)
+        return scores
+
+    def rank(self, text):
+        # best rows first, ties in table order
+        scores = self.score(text)
+        return sorted(range(self.num_rows), key=lambda i: -scores[i])
+
+    def top_k(self, text, k):
+        # the k best rows, in table order
+        return sorted(self.rank(text)[:k])
+
+
+def get_row_index(table_text):
+    table = Table.from_table_text(table_text)
+    return table.memoize("row_index", lambda: RowIndex(table))
@@ -0,0 +1,62 @@
+# Copyright 2024 The Chain-of-Table authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import os
+import sqlite3
+import threading
+
+
+def connect_sqlite(path, timeout=60):
+    dirname = os.path.dirname(path)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    # autocommit mode, transactions are opened explicitly with BEGIN IMMEDIATE
+    conn = sqlite3.connect(path, timeout=timeout, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+class SQLiteStore:
+    """Base class for state kept in a SQLite file shared between processes."""
+
+    schema = []
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def __getstate__(self):
+        # sqlite connections cannot be shared with (or pickled to) other processes
+        state = self.__dict__.copy()
+        del state["_local"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+    def _get_conn(self):
+        # one connection per process and thread, as sqlite connections cannot
+        # be used from other threads (e.g. the thread pools of add_column and
+        # the async scheduler)
+        local = self._local
+        if getattr(local, "conn", None) is None or local.pid != os.getpid():
+            conn = connect_sqlite(self.path)
+            for statement in self.schema:
+                conn.execute(statement)
+            local.conn = conn
+            local.pid = os.getpid()
+        return local.conn
@@ -0,0 +1,186 @@
+# Copyright 2024 The Chain-of-Table authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import hashlib
+import json
+
+
+def table_fingerprint(table_text):
+    if isinstance(table_text, Table):
+        table_text = table_text.to_table_text()
+    return hashlib.sha1(
+        json.dumps(table_text, ensure_ascii=False).encode("utf-8")
+    ).hexdigest()
+
+
+class Table:
+    """Immutable column-major table.
+
+    Selecting rows, selecting columns and sorting return views that share the
+    column storage of the original table; adding a column only builds the new
+    column. Indexing follows the list-of-rows `table_text` format, i.e.
+    `table[0]` is the header and `table[1:]` are the rows.
+    """
+
+    __slots__ = (
+        "_headers",
+        "_columns",
+        "_num_base_rows",
+        "_row_ids",
+        "_column_ids",
+        "_memo",
+    )
+
+    def __init__(self, headers, columns, num_base_rows, row_ids=None, column_ids=None):
+        self._headers = tuple(headers)
+        self._columns = tuple(columns)
+        self._num_base_rows = num_base_rows
+        self._row_ids = tuple(range(num_base_rows)) if row_ids is None else row_ids
+        self._column_ids = (
+            tuple(range(len(self._headers))) if column_ids is None else column_ids
+        )
+        # values derived from this (immutable) table, see `memoize`
+        self._memo = {}
+
+    @classmethod
+    def from_table_text(cls, table_text):
+        if isinstance(table_text, Table):
+            return table_text
+        headers = table_text[0]
+        rows = table_text[1:]
+        columns = [tuple(row[j] for row in rows) for j in range(len(headers))]
+        return cls(headers, columns, len(rows))
+
+    def _view(self, row_ids=None, column_ids=None):
+        return Table(
+            self._headers,
+            self._columns,
+            self._num_base_rows,
+            self._row_ids if row_ids is None else row_ids,
+            self._column_ids if column_ids is None else column_ids,
+        )
+
+    @property
+    def header(self):
+        return [self._headers[j] for j in self._column_ids]
+
+    @property
+    def num_rows(self):
+        return len(self._row_ids)
+
+    @property
+    def num_columns(self):
+        return len(self._column_ids)
+
+    def column_index(self, name):
+        return self.header.index(name)
+
+    def column(self, index):
+        # `index` is a position in the header or a column name
+        if isinstance(index, str):
+            index = self.column_index(index)
+        column = self._columns[self._column_ids[index]]
+        return [column[i] for i in self._row_ids]
+
+    def columns(self):
+        return [self.column(j) for j in range(self.num_columns)]
+
+    def row(self, index):
+        return [self._columns[j][self._row_ids[index]] for j in self._column_ids]
+
+    def rows(self):
+        columns = [self._columns[j] for j in self._column_ids]
+        return [[column[i] for column in columns] for i in self._row_ids]
+
+    def select_rows(self, indices):
+        # `indices` are positions of the current rows, in the new order
+        return self._view(row_ids=tuple(self._row_ids[i] for i in indices))
+
+    def select_columns(self, indices):
+        return self._view(column_ids=tuple(self._column_ids[j] for j in indices))
+
+    def add_column(self, name, values):
+        if len(values) != self.num_rows:
+            raise ValueError(
+                f"Column {name} has {len(values)} values for {self.num_rows} rows"
+            )
+        # rows that are not part of this view stay empty
+        new_column = [""] * self._num_base_rows
+        for i, v in zip(self._row_ids, values):
+            new_column[i] = v
+        table = Table(
+            self._headers + (name,),
+            self._columns + (tuple(new_column),),
+            self._num_base_rows,
+        )
+        return table._view(
+            row_ids=self._row_ids,
+            column_ids=self._column_ids + (len(self._headers),),
+        )
+
+    def memoize(self, key, compute):
+        if key not in self._memo:
+            self._memo[key] = compute()
+        return self._memo[key]
+
+    def to_table_text(self):
+        return [self.header] + self.rows()
+
+    def __len__(self):
+        return self.num_rows + 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(len(self))[index]]
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError("Table index out of range")
+        if index == 0:
+            return self.header
+        return self.row(index - 1)
+
+    def __iter__(self):
+        yield self.header
+        for row in self.rows():
+            yield row
+
+    def __eq__(self, other):
+        if isinstance(other, Table):
+            other = other.to_table_text()
+        return self.to_table_text() == other
+
+    def __getstate__(self):
+        # derived values are not worth shipping to other processes
+        return (
+            self._headers,
+            self._columns,
+            self._num_base_rows,
+            self._row_ids,
+            self._column_ids,
+        )
+
+    def __setstate__(self, state):
+        (
+            self._headers,
+            self._columns,
+            self._num_base_rows,
+            self._row_ids,
+            self._column_ids,
+        ) = state
+        self._memo = {}
+
+    def __repr__(self):
+        return f"Table({self.to_table_text()!r})"
@@ -0,0 +1,142 @@
+# Copyright 2024 The Chain-of-Table authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import sqlite3
+import threading
+
+import numpy as np
+
+from utils.profile import column_profile
+
+
+class SQLiteTable:
+    """In-memory SQLite copy of a Table, to run operations as queries.
+
+    Column j of the table is stored as `c{j}` (the cell), `s{j}` (the stripped
+    cell, NULL when empty) and `n{j}` (the number sort_column reads from the
+    cell, NULL when there is none). `pos` is the position of the row.
+    """
+
+    def __init__(self, table):
+        self.num_columns = table.num_columns
+        # tables are shared by the threads of the async scheduler
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(":memory:", check_same_thread=False)
+
+        fields = ["pos INTEGER PRIMARY KEY"]
+        columns = [range(table.num_rows)]
+        for j in range(table.num_columns):
+            fields += [f"c{j} TEXT", f"s{j} TEXT", f"n{j} REAL"]
+            profile = column_profile(table, j)
+            columns.append(profile["values"])
+            columns.append(
+                [
+                    None if is_null else v.strip()
+                    for v, is_null in zip(profile["values"], profile["null_mask"])
+                ]
+            )
+            columns.append(
+                [
+                    v if has_number else None
+                    for v, has_number in zip(
+                        profile["numeric"].tolist(), profile["number_mask"]
+                    )
+                ]
+            )
+        self.conn.execute(f"CREATE TABLE t ({', '.join(fields)})")
+        self.conn.executemany(
+            f"INSERT INTO t VALUES ({', '.join('?' * len(fields))})", zip(*columns)
+        )
+
+    def query(self, sql, parameters=()):
+        with self.lock:
+            return self.conn.execute(sql, parameters).fetchall()
+
+    def group_counts(self, index):
+        # [(value, count)] by decreasing count, then by value
+        return self.query(
+            f"SELECT c{index}, COUNT(*) AS count FROM t "
+            f"GROUP BY c{index} ORDER BY count DESC, c{index}"
+        )
+
+    def sort_order(self, index, numerical, reverse=False):
+        # positions and keys of the rows with a key, in a stable sort by key,
+        # then the positions of the rows without a key
+        key = f"n{index}" if numerical else f"s{index}"
+        direction = "DESC" if reverse else "ASC"
+        rows = self.query(
+            f"SELECT pos, {key} FROM t WHERE {key} IS NOT NULL "
+            f"ORDER BY {key} {direction}, pos"
+        )
+        missing = self.query(f"SELECT pos FROM t WHERE {key} IS NULL ORDER BY pos")
+        return [pos for pos, _ in rows], [v for _, v in rows], [pos for pos, in missing]
+
+
+class NumpyTable:
+    """NumPy arrays of the columns of a Table, with the same queries as
+    SQLiteTable. Arrays are built on first use of a column."""
+
+    def __init__(self, table):
+        self.table = table
+
+    def _values(self, index):
+        return self.table.memoize(
+            ("numpy_values", index),
+            lambda: np.array(column_profile(self.table, index)["values"], dtype=str),
+        )
+
+    def _keys(self, index, numerical):
+        # sort keys and the mask of the rows that have one
+        def _compute():
+            profile = column_profile(self.table, index)
+            if numerical:
+                mask = profile["number_mask"]
+                keys = profile["numeric"][mask]
+            else:
+                mask = ~profile["null_mask"]
+                keys = np.char.strip(self._values(index))[mask]
+            return keys, mask
+
+        return self.table.memoize(("numpy_keys", index, numerical), _compute)
+
+    def group_counts(self, index):
+        values, counts = np.unique(self._values(index), return_counts=True)
+        order = np.argsort(-counts, kind="stable")
+        return [(str(values[i]), int(counts[i])) for i in order]
+
+    def sort_order(self, index, numerical, reverse=False):
+        keys, mask = self._keys(index, numerical)
+        positions = np.flatnonzero(mask)
+        if reverse:
+            # stable descending sort: ties keep their order in the table
+            order = len(keys) - 1 - np.argsort(keys[::-1], kind="stable")[::-1]
+        else:
+            order = np.argsort(keys, kind="stable")
+        return (
+            positions[order].tolist(),
+            keys[order].tolist(),
+            np.flatnonzero(~mask).tolist(),
+        )
+
+
+def get_table_backend(table, backend):
+    # None for the python backend, that works on the cells directly
+    if backend == "python":
+        return None
+    elif backend == "sqlite":
+        return table.memoize("sqlite_table", lambda: SQLiteTable(table))
+    elif backend == "numpy":
+        return table.memoize("numpy_table", lambda: NumpyTable(table))
+    raise ValueError(f"Unknown table backend: {backend}")
@@ -0,0 +1,152 @@
+# Copyright 2024 The Chain-of-Table authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import functools
+import re
+
+from utils.row_index import get_row_index
+from utils.table import Table
+
+
+# context window (prompt + completion) of the chat models, the first matching
+# prefix wins
+MODEL_CONTEXT_WINDOWS = [
+    ("gpt-3.5-turbo-16k", 16385),
+    ("gpt-3.5-turbo-1106", 16385),
+    ("gpt-3.5-turbo-0125", 16385),
+    ("gpt-3.5-turbo", 4096),
+    ("gpt-4-32k", 32768),
+    ("gpt-4-1106", 128000),
+    ("gpt-4-0125", 128000),
+    ("gpt-4-turbo", 128000),
+    ("gpt-4o", 128000),
+    ("gpt-4", 8192),
+]
+
+# tokens of the chat format: around every message and to prime the reply
+TOKENS_PER_MESSAGE = 4
+TOKENS_PER_REPLY = 3
+
+
+def get_context_window(model_name):
+    # None for unknown models, whose prompts are never shrunk
+    for prefix, window in MODEL_CONTEXT_WINDOWS:
+        if model_name is not None and model_name.startswith(prefix):
+            return window
+    return None
+
+
+@functools.lru_cache(maxsize=None)
+def _get_encoding(model_name):
+    # None when the tokenizer cannot be loaded: tiktoken is not installed, or
+    # its BPE files cannot be downloaded. Prompts then get no budget instead
+    # of failing every request.
+    try:
+        import tiktoken
+
+        try:
+            return tiktoken.encoding_for_model(model_name)
+        except KeyError:
+            return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        print(f"No tokenizer for {model_name}, prompts are not budgeted: {e}")
+        return None
+
+
+def has_tokenizer(model_name=None):
+    return _get_encoding(model_name) is not None
+
+
+def count_tokens(text, model_name=None):
+    # only with a tokenizer, see `has_tokenizer`
+    return len(_get_encoding(model_name).encode(text, disallowed_special=()))
+
+
+def count_message_tokens(messages, model_name=None):
+    num_tokens = TOKENS_PER_REPLY
+    for message in messages:
+        num_tokens += TOKENS_PER_MESSAGE
+        for value in message.values():
+            num_tokens += count_tokens(value, model_name)
+    return num_tokens
+
+
+def _words(text):
+    return set(re.findall(r"\w+", str(text).lower()))
+
+
+def rank_columns(table, statement):
+    # columns named in the statement first, then the ones whose cells are in it
+    statement_words = _words(statement)
+    scores = []
+    for j, header in enumerate(table.header):
+        header_score = len(statement_words & _words(header))
+        cell_score = len(statement_words & _words(" ".join(table.column(j))))
+        scores.append((header_score, cell_score))
+    return sorted(range(table.num_columns), key=lambda j: scores[j], reverse=True)
+
+
+def fit_table(
+    llm,
+    llm_options,
+    table_text,
+    statement,
+    build_prompt,
+    num_rows=100,
+    drop_columns=True,
+):
+    """Shrinks a table until the prompt fits in the context window of `llm`.
+
+    `build_prompt(table, row_ids)` builds the full prompt of a table, where
+    `row_ids` are the 0-based ids of its rows in `table_text` (None when the
+    table is not shrunk). The rows least related to the statement (see
+    `RowIndex`) are dropped first, then the columns if a single row is still
+    too long.
+    Returns the arguments of `build_prompt` for the fitted table.
+    """
+    get_prompt_budget = getattr(llm, "get_prompt_budget", None)
+    budget = None if get_prompt_budget is None else get_prompt_budget(llm_options)
+    if budget is None:
+        return table_text, None
+
+    def _fits(table, row_ids):
+        return llm.count_prompt_tokens(build_prompt(table, row_ids)) <= budget
+
+    if _fits(table_text, None):
+        return table_text, None
+
+    table = Table.from_table_text(table_text)
+    ranked_rows = [i for i in get_row_index(table).rank(statement) if i < num_rows]
+    ranked_columns = rank_columns(table, statement)
+    num_columns = table.num_columns
+
+    def _shrink(num_kept_rows):
+        row_ids = sorted(ranked_rows[:num_kept_rows])
+        column_ids = sorted(ranked_columns[:num_columns])
+        return table.select_rows(row_ids).select_columns(column_ids), row_ids
+
+    # columns first, until at least one row fits
+    while drop_columns and num_columns > 1 and not _fits(*_shrink(1)):
+        num_columns -= 1
+
+    # then as many rows as possible
+    low, high = 1, len(ranked_rows)
+    while low < high:
+        mid = (low + high + 1) // 2
+        if _fits(*_shrink(mid)):
+            low = mid
+        else:
+            high = mid - 1
+    return _shrink(low)